@@ -0,0 +1,154 @@
+import numpy as np
+
+# these functions do the same math as the cursor measurements in goodLab.py, but on waveform records we've
+# already pulled off the scope, so measuring more points doesn't cost any more time on the instrument bus
+
+def current_steps(settings:dict):
+    i_sequence = np.array([0] + list(settings['i_sequence'][0]) + [0], dtype=float)
+    di = np.diff(i_sequence)      # change in current at each edge
+    midpoints = i_sequence[:-1] + di / 2      # current halfway through each edge
+    return di, midpoints
+
+def find_edges(settings:dict, t, i):
+    # time of each current edge, found where the current crosses the midpoint between the levels either side of it.
+    # works on the current in amps, so scale the current monitor voltage by i_scale_factor first
+    t = np.asarray(t, dtype=float)
+    i = np.asarray(i, dtype=float)
+    di, midpoints = current_steps(settings)
+    edges = []
+    start = 0
+    for k in range(len(di)):
+        if di[k] > 0:
+            crossings = np.flatnonzero((i[start:-1] <= midpoints[k]) & (i[start + 1:] > midpoints[k]))
+        else:
+            crossings = np.flatnonzero((i[start:-1] >= midpoints[k]) & (i[start + 1:] < midpoints[k]))
+        if len(crossings) == 0:
+            if k == 0:      # the first edge is what triggered the scope, so it's at 0 s if it's not in the record
+                edges.append(0.0)
+                continue
+            raise ValueError(f'Could not find current edge {k} at {midpoints[k]:.2f} A in the waveform.')
+        n = start + crossings[0]
+        # interpolate between the two samples either side of the threshold
+        frac = (midpoints[k] - i[n]) / (i[n + 1] - i[n])
+        edges.append(float(t[n] + frac * (t[n + 1] - t[n])))
+        start = n + 1
+    return edges
+
+def measurement_windows(settings:dict, edges, di):
+    # returns the cursor positions (a, b) the scope would use for each entry in measure_res_at
+    edges = np.asarray(edges, dtype=float)
+    steps = np.array([entry[0] for entry in settings['measure_res_at']], dtype=int)
+    over = np.array([entry[1] == 'min' for entry in settings['measure_res_at']])
+    freqs = np.array([1.0 if entry[1] == 'min' else float(entry[1]) for entry in settings['measure_res_at']])
+
+    slew_time = np.abs(di[steps]) / (settings['slew_rate'] * 1e6) / 2    # half the time it takes the load to slew through the edge
+    a = np.where(over, edges[steps] - 1e-3, edges[steps] - slew_time - 1 / freqs)
+    b_over = edges[np.minimum(steps + 1, len(edges) - 1)] - 1e-3
+    b = np.where(over, b_over, edges[steps] + slew_time + 1 / freqs)
+    return a, b, steps
+
+def resistances(settings:dict, t, v, edges):
+    # one resistance for every entry in measure_res_at, all computed at once
+    di, _ = current_steps(settings)
+    a, b, steps = measurement_windows(settings, edges, di)
+    dv = np.interp(b, t, v) - np.interp(a, t, v)
+    return np.abs(dv) / np.abs(di[steps])
+
+def combine_res(settings:dict, res_list):
+    # averages the measurements into a short term and long term resistance the same way calc_res always has:
+    # the long term value only uses the measurements over the longest step
+    st_res_list = []
+    lt_res_list = []
+    max_lt_res_dur = 0
+    for (step, freq), res in zip(settings['measure_res_at'], res_list):
+        if freq == 'min':
+            if settings['i_sequence'][1][step] > max_lt_res_dur:
+                max_lt_res_dur = settings['i_sequence'][1][step]
+                lt_res_list = [float(res)]
+            else:
+                lt_res_list.append(float(res))
+        else:
+            st_res_list.append(float(res))
+    st_res = sum(st_res_list) / len(st_res_list)
+    lt_res = sum(lt_res_list) / len(lt_res_list)
+    return st_res, lt_res
+
+def spectrum_bands(settings:dict):
+    # edges of the log spaced frequency bands from settings['spectrum_bands'] = [lowest Hz, highest Hz, number of bands]
+    low, high, count = settings['spectrum_bands']
+    return np.geomspace(low, high, int(count) + 1)
+
+def impedance_spectrum(settings:dict, t, v, i):
+    # the cell's impedance over a wide frequency range from the current steps we already record. the derivative of a
+    # step is an impulse, so the FFT of dv/dt over the FFT of di/dt is the impedance at every frequency the record
+    # resolves. all the steps go into one FFT: the cell is linear enough that their responses just add up, and the record
+    # starts and ends with no current, so there's no step cut off at either end. each band is the H1 estimate (every
+    # frequency weighted by how much current there is at it), so the frequencies the edges hardly excite count for little.
+    # returns the band centers in Hz and the complex impedance in ohms, nan where there wasn't enough current to measure it
+    v = np.asarray(v, dtype=float)
+    i = np.asarray(i, dtype=float)
+    bands = spectrum_bands(settings)
+    count = len(bands) - 1
+    dt = (t[-1] - t[0]) / (len(t) - 1)
+    dv = np.fft.rfft(np.diff(v))
+    di = np.fft.rfft(np.diff(i))
+    f = np.fft.rfftfreq(len(v) - 1, dt)
+    band = np.searchsorted(bands, f, side='right') - 1
+    use = (f > 0) & (band >= 0) & (band < count)
+    product = dv[use] * np.conj(di[use])
+    cross = np.bincount(band[use], weights=product.real, minlength=count) + 1j * np.bincount(band[use], weights=product.imag, minlength=count)
+    power = np.bincount(band[use], weights=np.abs(di[use]) ** 2, minlength=count)
+    z = np.full(count, np.nan, dtype=complex)
+    measured = power > 1e-9 * max(power.max(), 1e-300)
+    z[measured] = -cross[measured] / power[measured]    # the voltage drops when the current goes up
+    return np.sqrt(bands[:-1] * bands[1:]), z
+
+def spectrum_features(freqs, z):
+    # a few numbers per cell to match on, plus the real and imaginary parts in every band
+    features = {}
+    measured = ~np.isnan(z)
+    if np.any(measured):
+        features['r_hf'] = float(z[measured][-1].real)    # about the ohmic resistance
+        features['r_lf'] = float(z[measured][0].real)     # ohmic plus most of the polarization
+        peak = np.nanargmax(-z.imag)
+        features['f_peak'] = float(freqs[peak])     # 1 / (2 pi tau) of the slowest process the bands can see
+        features['im_peak'] = float(-z.imag[peak])
+    else:
+        features.update({'r_hf': np.nan, 'r_lf': np.nan, 'f_peak': np.nan, 'im_peak': np.nan})
+    for f, value in zip(freqs, z):
+        features[f'z_re_{f:.3g}Hz'] = float(value.real)
+        features[f'z_im_{f:.3g}Hz'] = float(value.imag)
+    return features
+
+def scale_waveform(raw, preamble:dict):
+    # convert raw digitizer values from CURVe? into time and volts using the values from WFMOutpre?
+    y = (np.asarray(raw, dtype=float) - preamble['YOFF']) * preamble['YMULT'] + preamble['YZERO']
+    t = preamble['XZERO'] + (np.arange(len(y)) - preamble['PT_OFF']) * preamble['XINCR']
+    return t, y
+
+def load_mat(filename:str):
+    # reads a waveform saved by Oscope.save_waveforms and returns time and volts.
+    # scipy is only needed for this, the live test doesn't use it
+    from scipy.io import loadmat
+    data = loadmat(filename, squeeze_me=True)
+    data = {key.lower(): value for key, value in data.items() if not key.startswith('__')}
+    time_names = ['time', 't', 'x']
+    arrays = [value for key, value in data.items() if key not in time_names and np.ndim(value) == 1 and np.size(value) > 1]
+    if len(arrays) == 0:
+        raise ValueError(f'No waveform found in {filename}')
+    y = np.asarray(max(arrays, key=len), dtype=float)     # the samples are the only long array in the file
+
+    # different scope firmware versions have used different names for the timing values
+    for name in time_names:
+        if name in data and np.size(data[name]) == len(y):
+            return np.asarray(data[name], dtype=float), y
+    t0 = next((float(data[name]) for name in ['tstart', 'xzero', 't0'] if name in data), None)
+    dt = next((float(data[name]) for name in ['tinterval', 'xincr', 'dt', 'sampleinterval'] if name in data), None)
+    if t0 is None or dt is None:
+        raise ValueError(f'No timing information found in {filename}')
+    return t0 + np.arange(len(y)) * dt, y
+
+def edges_from_file(settings:dict, filename:str):
+    # finds the edges in a saved <cell>_I.mat file
+    t, i = load_mat(filename)
+    return find_edges(settings, t, i * settings['i_scale_factor'])
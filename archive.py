@@ -0,0 +1,202 @@
+import argparse
+import os
+import threading
+from datetime import datetime
+import numpy as np
+import analysis
+from goodLab import Settings
+from reanalyze import find_waveforms
+
+# keeps every cell's V and I waveforms for a lot in two files instead of two .mat files per cell. samples are stored as
+# int16 with a scale and offset for each cell, a quarter of the size of the float64 records, and the files are
+# memory-mapped when they're read, so getting one cell or one step out of a lot of thousands doesn't load the rest.
+# compressing the samples would make them smaller again, but then they couldn't be memory-mapped.
+#   <root>/<lot>/V.i16, I.i16    the samples of every cell one after the other. I is in amps
+#   <root>/<lot>/index.npy        one row per cell: number, time tested, where its samples are, timing, scaling, edges
+#
+#   python archive.py ingest G7_2023 waveforms --lot G7_2023      add the .mat files saved by Oscope.save_waveforms
+#   python archive.py list waveforms                              every lot in the archive and how many cells it has
+
+def index_dtype(edges:int):
+    return np.dtype([('num', 'i8'), ('tested_at', 'M8[s]'), ('offset', 'i8'), ('length', 'i8'), ('t0', 'f8'), ('dt', 'f8'),
+                     ('v_scale', 'f8'), ('v_offset', 'f8'), ('i_scale', 'f8'), ('i_offset', 'f8'), ('edges', 'f8', (edges,))])
+
+def quantize(y):
+    # maps the record onto the full int16 range, returns the samples and how to get volts or amps back
+    y = np.asarray(y, dtype=float)
+    low, high = float(np.min(y)), float(np.max(y))
+    offset = (high + low) / 2
+    scale = (high - low) / 65534 if high > low else 1.0
+    return np.round((y - offset) / scale).astype('<i2'), scale, offset
+
+class Lot:
+    def __init__(self, path:str, edges:int = None):
+        self.path = path
+        self.lock = threading.Lock()    # stations can add cells from different threads
+        index_path = os.path.join(path, 'index.npy')
+        if os.path.exists(index_path):
+            self.index = np.load(index_path)
+        else:
+            self.index = np.zeros(0, dtype=index_dtype(edges if edges is not None else len(Settings['i_sequence'][0]) + 1))
+        self.rows = {num: row for row, num in enumerate(self.index['num'].tolist())}
+        self.maps = {}
+
+    def end(self):
+        # where the next cell's samples go, the same in both files
+        return int(np.max(self.index['offset'] + self.index['length'])) if len(self.index) > 0 else 0
+
+    def trim(self):
+        # cuts off any samples the index doesn't point at, left by a crash or an error between writing a cell's
+        # samples and its index row. otherwise V and I would have different lengths and every later cell would be off.
+        # only add() calls this, with the lock held: a reader opening the lot while a cell is being added would see
+        # samples the new index row isn't saved for yet. one process adds to a lot at a time
+        end = self.end()
+        for channel in ['V', 'I']:
+            path = os.path.join(self.path, f'{channel}.i16')
+            if os.path.exists(path) and os.path.getsize(path) > end * 2:
+                os.truncate(path, end * 2)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, num:int):
+        return num in self.rows
+
+    def add(self, num:int, t, v, i, edges, tested_at:datetime = None):
+        # appends one cell. t has to be evenly spaced, v and i on the same time base, i in amps
+        t = np.asarray(t, dtype=float)
+        if len(v) != len(t) or len(i) != len(t):
+            raise ValueError(f'Cell {num}: V and I have to have the same number of samples as the time base')
+        if len(edges) != self.index.dtype['edges'].shape[0]:
+            raise ValueError(f'Cell {num}: {len(edges)} edges, this lot has {self.index.dtype["edges"].shape[0]}')
+        v_raw, v_scale, v_offset = quantize(v)
+        i_raw, i_scale, i_offset = quantize(i)
+        with self.lock:
+            if num in self.rows:
+                raise ValueError(f'Cell {num} is already in {self.path}')
+            self.maps = {}      # a memory map would stop the files being truncated on some systems
+            os.makedirs(self.path, exist_ok=True)
+            self.trim()
+            offset = self.end()
+            for channel, raw in [('V', v_raw), ('I', i_raw)]:
+                with open(os.path.join(self.path, f'{channel}.i16'), 'ab') as file:
+                    file.write(raw.tobytes())
+            row = np.zeros(1, dtype=self.index.dtype)
+            row['num'] = num
+            row['tested_at'] = np.datetime64(tested_at if tested_at is not None else datetime.now(), 's')
+            row['offset'] = offset
+            row['length'] = len(t)
+            row['t0'] = t[0]
+            row['dt'] = (t[-1] - t[0]) / (len(t) - 1) if len(t) > 1 else 0.0
+            row['v_scale'], row['v_offset'], row['i_scale'], row['i_offset'] = v_scale, v_offset, i_scale, i_offset
+            row['edges'] = edges
+            self.index = np.concatenate((self.index, row))
+            self.rows[num] = len(self.index) - 1
+            # the samples are written before the index, so a crash part way through never leaves a row pointing at nothing
+            np.save(os.path.join(self.path, 'index.tmp.npy'), self.index)
+            os.replace(os.path.join(self.path, 'index.tmp.npy'), os.path.join(self.path, 'index.npy'))
+            self.maps = {}      # the files have grown, map them again next time
+
+    def samples(self, channel:str):
+        # the channel file up to the end of the last cell in the index, memory-mapped. anything after that is a cell
+        # that's still being added, or was left by a crash
+        with self.lock:
+            if channel not in self.maps:
+                self.maps[channel] = np.memmap(os.path.join(self.path, f'{channel}.i16'), dtype='<i2', mode='r', shape=(self.end(),))
+            return self.maps[channel]
+
+    def info(self, num:int):
+        return self.index[self.rows[num]]
+
+    def raw(self, num:int, channel:str, start:int = 0, stop:int = None):
+        # int16 samples start:stop of one cell straight out of the memory map, nothing is copied
+        row = self.info(num)
+        stop = row['length'] if stop is None else min(stop, row['length'])
+        return self.samples(channel)[row['offset'] + max(0, start):row['offset'] + stop]
+
+    def window(self, num:int, t_start:float = None, t_stop:float = None):
+        # time, volts and amps between two times. only these samples are read from disk and scaled
+        row = self.info(num)
+        start = 0 if t_start is None else int(np.ceil((t_start - row['t0']) / row['dt']))
+        stop = row['length'] if t_stop is None else int(np.floor((t_stop - row['t0']) / row['dt'])) + 1
+        start, stop = max(0, start), min(int(row['length']), stop)
+        t = row['t0'] + np.arange(start, stop) * row['dt']
+        v = self.raw(num, 'V', start, stop) * row['v_scale'] + row['v_offset']
+        i = self.raw(num, 'I', start, stop) * row['i_scale'] + row['i_offset']
+        return t, v, i
+
+    def step(self, num:int, step:int, pad:float = 0.0):
+        # the part of the record where the load was at i_sequence step `step`, the same numbering as measure_res_at
+        edges = self.info(num)['edges']
+        t_stop = edges[step + 1] if step + 1 < len(edges) else None
+        return self.window(num, edges[step] - pad, None if t_stop is None else t_stop + pad)
+
+class Archive:
+    def __init__(self, root:str):
+        self.root = root
+        self.lots = {}
+
+    def lot(self, name:str):
+        if name not in self.lots:
+            self.lots[name] = Lot(os.path.join(self.root, name))
+        return self.lots[name]
+
+    def lot_names(self):
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(name for name in os.listdir(self.root) if os.path.exists(os.path.join(self.root, name, 'index.npy')))
+
+    def index(self):
+        # every lot's index in one array with the lot name added, for queries across lots. only reads the index files
+        tables = []
+        for name in self.lot_names():
+            lot_index = self.lot(name).index
+            table = np.zeros(len(lot_index), dtype=[('lot', 'U64'), ('num', 'i8'), ('tested_at', 'M8[s]'), ('t0', 'f8'), ('dt', 'f8'), ('length', 'i8')])
+            table['lot'] = name
+            for key in ['num', 'tested_at', 't0', 'dt', 'length']:
+                table[key] = lot_index[key]
+            tables.append(table)
+        return np.concatenate(tables) if len(tables) > 0 else np.zeros(0, dtype=[('lot', 'U64'), ('num', 'i8')])
+
+def ingest(folder:str, lot:Lot, settings:dict = Settings):
+    # adds every cell in a folder of .mat files that isn't in the lot yet. returns {num: error} for the ones that failed
+    failed = {}
+    for num, (v_path, i_path) in find_waveforms(folder).items():
+        if num in lot:
+            continue
+        try:
+            t, v = analysis.load_mat(v_path)
+            t_i, i = analysis.load_mat(i_path)
+            i = i * settings['i_scale_factor']
+            if len(t_i) != len(t) or not np.isclose(t_i[0], t[0]):
+                i = np.interp(t, t_i, i)    # both channels come from one acquisition, so this shouldn't happen
+            edges = analysis.find_edges(settings, t, i)
+            lot.add(num, t, v, i, edges, datetime.fromtimestamp(os.path.getmtime(v_path)))
+        except Exception as e:
+            failed[num] = f'{type(e).__name__}: {e}'
+    return failed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Keep cell waveforms in one memory-mapped archive per lot.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    ingest_parser = commands.add_parser('ingest', help='add the <num>_V.mat and <num>_I.mat files in a folder to a lot')
+    ingest_parser.add_argument('folder')
+    ingest_parser.add_argument('root', help='archive folder')
+    ingest_parser.add_argument('--lot', default=Settings['group_name'])
+    list_parser = commands.add_parser('list', help='show the lots in an archive')
+    list_parser.add_argument('root', help='archive folder')
+    args = parser.parse_args()
+
+    archive = Archive(args.root)
+    if args.command == 'ingest':
+        lot = archive.lot(args.lot)
+        before = len(lot)
+        failed = ingest(args.folder, lot)
+        for num, error in failed.items():
+            print(f'Cell {num}: {error}')
+        print(f'Added {len(lot) - before} cells to {args.lot}, {len(lot)} in total, {len(failed)} failed')
+    else:
+        index = archive.index()
+        for name in archive.lot_names():
+            cells = index[index['lot'] == name]
+            print(f'{name}: {len(cells)} cells, tested {cells["tested_at"].min()} to {cells["tested_at"].max()}')
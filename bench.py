@@ -0,0 +1,104 @@
+import argparse
+import os
+import tempfile
+import goodLab
+from sim_visa import Clock, SimCell, SimResourceManager
+
+# times a full cell test against the simulated instruments in sim_visa.py and shows where the time goes.
+#   python bench.py                     cursor measurements, the way goodLab.py runs by default
+#   python bench.py --local             local waveform analysis
+#   python bench.py --latency 0.01      10 ms per SCPI transaction
+#   python bench.py --pipelined         save waveforms and results on the background worker (the virtual clock is shared
+#                                       between threads, so use --real-time as well to see the overlap in the wall times)
+#   python bench.py --real-time         actually wait instead of running on a virtual clock
+
+PHASES = ['discovery', 'Load.__init__', 'setup', 'trigger', 'find_edges', 'calc_res', 'save']
+
+class PhaseStats:
+    def __init__(self, rm:SimResourceManager):
+        self.rm = rm
+        self.results = {phase: {'wall': 0.0, 'round_trips': 0, 'sleep': 0.0} for phase in PHASES}
+        self.sleep_total = 0.0
+
+    def sleep(self, secs:float):
+        # stands in for goodLab's sleep so we can see how much of each phase is spent sleeping
+        self.sleep_total += secs
+        self.rm.clock.sleep(secs)
+
+    def run(self, phase:str, func, *args):
+        start = self.rm.clock.now()
+        round_trips = self.rm.round_trips
+        sleep_total = self.sleep_total
+        result = func(*args)
+        self.results[phase]['wall'] += self.rm.clock.now() - start
+        self.results[phase]['round_trips'] += self.rm.round_trips - round_trips
+        self.results[phase]['sleep'] += self.sleep_total - sleep_total
+        return result
+
+def run_bench(cells:int = 1, latency:float = 0.002, local:bool = False, virtual:bool = True, record_length:int = 1000000, pipelined:bool = False):
+    goodLab.Settings['local_analysis'] = local
+    goodLab.Settings['pipelined'] = pipelined
+    rm = SimResourceManager(goodLab.Settings, latency=latency, clock=Clock(virtual), cell=SimCell(), record_length=record_length)
+    stats = PhaseStats(rm)
+    goodLab.sleep = stats.sleep
+
+    load_res, scope_res = stats.run('discovery', goodLab.find_instruments, rm)
+    scope = goodLab.Oscope(scope_res)
+    load = stats.run('Load.__init__', goodLab.Load, load_res)
+    stats.run('setup', goodLab.setup_scope, scope, tempfile.gettempdir())
+    cell_data_path = os.path.join(tempfile.gettempdir(), 'bench_results.csv')
+    header = ['num', 'v0', 'res_st', 'res_lt']
+    with open(cell_data_path, 'w') as csvfile:     # not load_cell_data(), that would add it to svn
+        csvfile.write('num,v0,res_st,res_lt\n')
+    ranking = goodLab.Ranking()
+    worker = goodLab.ResultWorker() if pipelined else None
+
+    for cell_num in range(1, cells + 1):
+        v0 = load.v()
+        expected_min_v = v0 - max(goodLab.Settings['i_sequence'][0]) * ranking.mean('res_lt', goodLab.Settings['default_res'])
+        stats.run('setup', scope.set_v_range, goodLab.Settings['v_channel'], expected_min_v - 0.2, v0 + 0.1)
+        stats.run('setup', scope.wait_until_ready)
+        if worker is not None:
+            stats.run('save', worker.scope_free.wait)
+        times = scope.times_triggered()
+        stats.run('trigger', load.trigger)
+        if not stats.run('trigger', scope.wait_for_acquisition, times):
+            raise RuntimeError('The simulated scope was not triggered.')
+        stats.run('find_edges', scope.find_edges)
+        res_st, res_lt = stats.run('calc_res', goodLab.calc_res, scope)
+        cell = {"num": cell_num, "v0": v0, "res_st": res_st, "res_lt": res_lt}
+        ranks = stats.run('save', goodLab.rank_cell, ranking, cell)
+        if worker is not None:
+            stats.run('save', worker.submit, scope, cell_num, cell, ranks, header, cell_data_path)
+        else:
+            stats.run('save', scope.save_waveforms, str(cell_num))
+            stats.run('save', goodLab.record_result, cell, ranks, header, cell_data_path)
+    if worker is not None:
+        worker.close()
+    return stats
+
+def print_report(stats:PhaseStats, cells:int):
+    print(f'\n{"phase":<16}{"wall (s)":>12}{"round trips":>14}{"sleep (s)":>12}')
+    totals = {'wall': 0.0, 'round_trips': 0, 'sleep': 0.0}
+    for phase in PHASES:
+        result = stats.results[phase]
+        print(f'{phase:<16}{result["wall"]:>12.3f}{result["round_trips"]:>14}{result["sleep"]:>12.3f}')
+        for key in totals:
+            totals[key] += result[key]
+    print(f'{"total":<16}{totals["wall"]:>12.3f}{totals["round_trips"]:>14}{totals["sleep"]:>12.3f}')
+    per_cell = sum(stats.results[phase]['wall'] for phase in ['trigger', 'find_edges', 'calc_res', 'save']) / cells
+    print(f'\n{per_cell:.2f} s per cell (not counting setup), {3600 / per_cell:.0f} cells/hour')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark a goodLab cell test against simulated instruments.')
+    parser.add_argument('--cells', type=int, default=1, help='number of cells to test')
+    parser.add_argument('--latency', type=float, default=0.002, help='seconds per SCPI transaction')
+    parser.add_argument('--local', action='store_true', help='use local waveform analysis instead of the scope cursors')
+    parser.add_argument('--record-length', type=int, default=1000000, help='number of points in each simulated waveform')
+    parser.add_argument('--pipelined', action='store_true', help='save waveforms and results on the background worker')
+    parser.add_argument('--real-time', action='store_true', help='actually wait instead of using a virtual clock')
+    args = parser.parse_args()
+
+    os.chdir(tempfile.gettempdir())     # goodLab logs to log.txt in the working directory
+    stats = run_bench(args.cells, args.latency, args.local, not args.real_time, args.record_length, args.pipelined)
+    print_report(stats, args.cells)
@@ -0,0 +1,65 @@
+import argparse
+import os
+import tempfile
+from time import perf_counter
+import numpy as np
+import cellect
+
+# times cellect.py on synthetic lots so we know sorting stays quick as the lots get bigger.
+#   python bench_cellect.py                         10k, 100k and 1M cells
+#   python bench_cellect.py --sizes 10000 50000     just these lot sizes
+#   python bench_cellect.py --cells-per-module 10
+#   python bench_cellect.py --solver greedy         the old center-outward assign_to_modules
+
+PHASES = ['read_cells', 'sort_cells', 'module_list', 'cell_list']
+
+def make_lot(filename:str, cells:int, seed:int = 0):
+    # roughly the spread of the G7 lot: long term resistance goes down as the cell voltage goes up
+    rng = np.random.default_rng(seed)
+    v0 = rng.normal(3.49, 0.02, cells)
+    res_st = rng.normal(0.019, 0.0008, cells)
+    res_lt = res_st + 0.031 - 0.05 * (v0 - 3.49) + rng.normal(0, 0.0006, cells)
+    nums = np.arange(1, cells + 1)
+    with open(filename, 'w') as file:
+        file.write('num,v0,res_st,res_lt\n')
+        np.savetxt(file, np.column_stack((nums, v0, res_st, res_lt)), delimiter=',', fmt=['%03d', '%.2f', '%r', '%r'])
+
+def run_bench(cells:int, path:str, solver:str = None):
+    filename = os.path.join(path, f'lot_{cells}.csv')
+    make_lot(filename, cells)
+    times = {}
+
+    start = perf_counter()
+    lot = cellect.read_cells(filename)
+    times['read_cells'] = perf_counter() - start
+
+    start = perf_counter()
+    cells_sorted, total_modules = cellect.sort_cells(lot, plot=False, solver=solver)
+    times['sort_cells'] = perf_counter() - start
+
+    start = perf_counter()
+    cellect.write_module_list(cells_sorted, total_modules, os.path.join(path, 'module_list.txt'))
+    times['module_list'] = perf_counter() - start
+
+    start = perf_counter()
+    cellect.write_cell_list(cells_sorted, os.path.join(path, 'cell_list.txt'))
+    times['cell_list'] = perf_counter() - start
+    return times, cellect.module_quality(cells_sorted)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark cellect.py on synthetic lots of cells.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000], help='number of cells in each lot')
+    parser.add_argument('--cells-per-module', type=int, default=cellect.CELLS_PER_MODULE, help='cells in each module')
+    parser.add_argument('--solver', choices=['window', 'greedy'], default=cellect.SOLVER, help='how to match cells into modules')
+    args = parser.parse_args()
+    cellect.CELLS_PER_MODULE = args.cells_per_module
+
+    results = {}
+    with tempfile.TemporaryDirectory() as path:
+        for cells in args.sizes:
+            results[cells], quality = run_bench(cells, path, args.solver)
+            cellect.print_quality(quality)
+
+    print(f'\n{"cells":>10}' + ''.join(f'{phase:>14}' for phase in PHASES) + f'{"total (s)":>12}')
+    for cells, times in results.items():
+        print(f'{cells:>10}' + ''.join(f'{times[phase]:>14.3f}' for phase in PHASES) + f'{sum(times.values()):>12.3f}')
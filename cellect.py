@@ -1,156 +1,434 @@
+import argparse
+import csv
+import hashlib
+import itertools
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
-import matplotlib.pyplot as plt
+
+# sorts a lot of tested cells into modules of matched cells and writes module_list.txt and cell_list.txt.
+#   python cellect.py
+#   python cellect.py --sweep --exclude-sigma 0.25 0.5 1 --cells-per-module 10 12
+#       sorts the lot with every combination of the settings instead and writes how each one turned out to sweep.csv
+# if the CSV, the settings and this file haven't changed since the last run and the outputs are all there, it stops
+# without redoing them. --force redoes them anyway
 
 CELL_DATA_PATH = 'G7_2023.csv'
 CELLS_PER_MODULE = 12
+SOLVER = 'window'   # 'window' for match_modules, 'greedy' for the old center-outward assign_to_modules
+MATCH_KEYS = {'lt': 1.0, 'st': 0.5, 'v0': 1.0}  # the values match_modules matches cells on, most important first, and how much
+                                                # each one's spread counts. spreads are in standard deviations of the lot
+BAND_MODULES = 1    # each value after the first is matched within bands of this many modules of the one before it
+MAX_SPREAD = 5.0    # each module counts for 1 - spread / MAX_SPREAD, so a module this spread out is never made, and a worse
+                    # matched one is only made if it's worth more than the cells it uses would be elsewhere. None makes as
+                    # many modules as it can
+EXCLUDE_SIGMA = 0.5     # cells whose dev_st is more than this many standard deviations above the mean are matched last
+FIT_ORDER = 1   # order of the polynomial fit of long term resistance against v0. it's only used for the dev_lt column
+
+CELL_DTYPE = [('num', 'i8'), ('v0', 'f8'), ('st', 'f8'), ('lt', 'f8')]
+OUTPUTS = ['module_list.txt', 'cell_list.txt', 'useless_details--NOT_important--DO_NOT_READ.csv']
+PLOTS = ['dev_st distribution.png', 'deviations by module.png']
+FINGERPRINT_PATH = 'cellect.sha1'   # the fingerprint of the inputs the outputs were made from
+
+SORTED_DTYPE = CELL_DTYPE + [('dev_st', 'f8'), ('dev_lt', 'f8'), ('dev', 'f8'), ('largest_dev', 'U2'), ('dist', 'f8'), ('abs_dist', 'f8'), ('mod', 'i8')]
+
+def pyplot():
+    # matplotlib takes longer to import than sorting a lot does, so only when there's something to plot. Agg draws
+    # straight to the files without needing a display
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
 
 def read_cells(filename):
-    cells = np.genfromtxt(fname=filename, delimiter=',', names=True, dtype=None)
-    cells = np.array([(cell['num'], cell['v0'], cell['res_st'], cell['res_lt'] - cell['res_st']) for cell in cells], dtype=[('num', 'i8'), ('v0', 'f8'), ('st', 'f8'), ('lt', 'f8')])
-    
-    for i, cell in enumerate(cells):
-        if cell['num'] in [cell['num'] for cell in cells[:i]]:
-            print('Duplicate cell number found:', cell['num'])
-            print('This cell must have been tested more than once.')
-            print('Decide which result is valid and remove all others.')
-            exit(1)
+    with open(filename, 'r') as file:
+        names = file.readline().strip().split(',')
+    columns = [names.index(name) for name in ['num', 'v0', 'res_st', 'res_lt']]
+    data = np.loadtxt(filename, delimiter=',', skiprows=1, usecols=columns, ndmin=2)    # much faster than genfromtxt on big lots
+    cells = np.zeros(len(data), dtype=CELL_DTYPE)
+    cells['num'] = data[:, 0]
+    cells['v0'] = data[:, 1]
+    cells['st'] = data[:, 2]
+    cells['lt'] = data[:, 3] - data[:, 2]
+
+    nums, counts = np.unique(cells['num'], return_counts=True)
+    if np.any(counts > 1):
+        print('Duplicate cell number found:', ', '.join(str(num) for num in nums[counts > 1]))
+        print('This cell must have been tested more than once.')
+        print('Decide which result is valid and remove all others.')
+        exit(1)
     return cells
 
-def process_cells(cells):
-    y = np.array([cell['lt'] for cell in cells])
-    x = np.array([cell['v0'] for cell in cells])
-    fit = np.polynomial.polynomial.Polynomial.fit(x, y, 1)
-    dev_lt = np.abs(cells['lt'] - fit(cells['v0'])) / fit(cells['v0'])
-    
-    avg_st = np.mean(cells['st'])
+def deviations(cells, fit, avg_st):
+    # relative deviation of each cell from the mean short term resistance and from the fit of long term resistance against voltage
+    expected_lt = fit(cells['v0'])
     dev_st = np.abs(cells['st'] - avg_st) / avg_st
+    dev_lt = np.abs(cells['lt'] - expected_lt) / expected_lt
+    return dev_st, dev_lt
 
-    # remove cells with dev_st > 1/2 standard deviation
-    std_dev_st = np.std(dev_st)
-    st_mean = np.mean(dev_st)
-    bad_cells = cells[dev_st >= st_mean + 0.5 * std_dev_st]
-    cells = cells[dev_st < st_mean + 0.5 * std_dev_st]
+def with_details(cells, dev_st, dev_lt, median_lt):
+    # fills in every column of SORTED_DTYPE at once instead of building a tuple for each cell
+    details = np.zeros(len(cells), dtype=SORTED_DTYPE)
+    for name in ['num', 'v0', 'st', 'lt']:
+        details[name] = cells[name]
+    details['dev_st'] = dev_st
+    details['dev_lt'] = dev_lt
+    details['dev'] = np.maximum(dev_lt, dev_st)
+    details['largest_dev'] = np.where(dev_st > dev_lt, 'st', 'lt')
+    details['dist'] = cells['lt'] - median_lt
+    details['abs_dist'] = np.abs(details['dist'])
+    return details
 
-    dev_st = np.abs(cells['st'] - avg_st) / avg_st
-    dev_lt = np.abs(cells['lt'] - fit(cells['v0'])) / fit(cells['v0'])
-    largest_dev = np.where(dev_st > dev_lt, 'st', 'lt')
+def take(cells, index):
+    # gathers whole records as raw bytes. numpy copies a structured array field by field otherwise, which is slow on big lots
+    records = cells.view(np.dtype((np.void, cells.dtype.itemsize)))
+    return records[index].view(cells.dtype)
 
-    bc_dev_st = np.abs(bad_cells['st'] - avg_st) / avg_st
-    bc_dev_lt = np.abs(bad_cells['lt'] - fit(bad_cells['v0'])) / fit(bad_cells['v0'])
-    bc_largest_dev = np.where(bc_dev_st > bc_dev_lt, 'st', 'lt')
+def sort_by(cells, key):
+    # same order as np.sort(cells, order=key), cell numbers are unique so they settle any ties. much faster on big arrays
+    return take(cells, np.lexsort((cells['num'], cells[key])))
 
-    median_lt = np.median(cells['lt'])
-    cells = np.array([(cell['num'], cell['v0'], cell['st'], cell['lt'], dev_st[i], dev_lt[i], max(dev_lt[i], dev_st[i]), largest_dev[i], cell['lt'] - median_lt, abs(cell['lt'] - median_lt), 0) for i, cell in enumerate(cells)], dtype=[('num', 'i8'), ('v0', 'f8'), ('st', 'f8'), ('lt', 'f8'), ('dev_st', 'f8'), ('dev_lt', 'f8'), ('dev', 'f8'), ('largest_dev', 'U2'), ('dist', 'f8'), ('abs_dist', 'f8'), ('mod', 'i8')])
-    bad_cells = np.array([(cell['num'], cell['v0'], cell['st'], cell['lt'], bc_dev_st[i], bc_dev_lt[i], max(bc_dev_lt[i], bc_dev_st[i]), bc_largest_dev[i], cell['lt'] - median_lt, abs(cell['lt'] - median_lt), 0) for i, cell in enumerate(bad_cells)], dtype=[('num', 'i8'), ('v0', 'f8'), ('st', 'f8'), ('lt', 'f8'), ('dev_st', 'f8'), ('dev_lt', 'f8'), ('dev', 'f8'), ('largest_dev', 'U2'), ('dist', 'f8'), ('abs_dist', 'f8'), ('mod', 'i8')])
-    
-    cells = np.sort(cells, order='abs_dist')
-    
-    while (len(cells) % CELLS_PER_MODULE > 0):
-        bad_cells = np.concatenate((bad_cells, [cells[-1]]))
-        cells = np.delete(cells, -1)
-    
-    print('Number of cells excluded:', len(bad_cells))
-    print('Number of cells remaining:', len(cells))
+def process_cells(cells, plot=True, per_module=None, exclude_sigma=None, fit_order=None, verbose=True):
+    per_module = CELLS_PER_MODULE if per_module is None else per_module
+    exclude_sigma = EXCLUDE_SIGMA if exclude_sigma is None else exclude_sigma
+    fit_order = FIT_ORDER if fit_order is None else fit_order
+    fit = np.polynomial.polynomial.Polynomial.fit(cells['v0'], cells['lt'], fit_order)
+    avg_st = np.mean(cells['st'])
+    dev_st, dev_lt = deviations(cells, fit, avg_st)
+
+    # remove cells with dev_st > exclude_sigma standard deviations
+    good = dev_st < np.mean(dev_st) + exclude_sigma * np.std(dev_st)
+    median_lt = np.median(cells['lt'][good])
+    bad_cells = with_details(take(cells, ~good), dev_st[~good], dev_lt[~good], median_lt)
+    cells = with_details(take(cells, good), dev_st[good], dev_lt[good], median_lt)
+
+    cells = sort_by(cells, 'abs_dist')
 
-    # plot the distribution of dev_st
-    plt.hist(dev_st, bins=40)
-    plt.xlabel('Deviation from mean')
-    plt.ylabel('Number of cells')
-    plt.tight_layout()
-    plt.savefig('dev_st distribution')
-    plt.clf()
+    # the cells furthest from the median don't fill a whole module
+    extra = len(cells) % per_module
+    if extra > 0:
+        bad_cells = np.concatenate((bad_cells, cells[:-extra - 1:-1]))
+        cells = cells[:-extra]
+
+    if verbose:
+        print('Number of cells excluded:', len(bad_cells))
+        print('Number of cells remaining:', len(cells))
+
+    if plot:
+        # plot the distribution of dev_st
+        plt = pyplot()
+        plt.hist(dev_st[good], bins=40)
+        plt.xlabel('Deviation from mean')
+        plt.ylabel('Number of cells')
+        plt.tight_layout()
+        plt.savefig('dev_st distribution')
+        plt.clf()
 
     return cells, bad_cells
 
-def assign_to_modules(cells, starting_module=1):
-    cells = np.sort(cells, order='dist')
+def assign_to_modules(cells, starting_module=1, per_module=None):
+    per_module = CELLS_PER_MODULE if per_module is None else per_module
+    cells = sort_by(cells, 'dist')
     total = len(cells)
 
     # find the index of the cell with dist closest to 0
     median_index = np.argmin(np.abs(cells['dist']))
     
 
-    center = median_index - CELLS_PER_MODULE // 2
+    center = median_index - per_module // 2
 
     mod = 1
-    lower = round(center - CELLS_PER_MODULE // 2)
-    upper = round(center + np.ceil(CELLS_PER_MODULE / 2))
+    lower = round(center - per_module // 2)
+    upper = round(center + np.ceil(per_module / 2))
     up_or_down = 1
     
     while lower >= 0 and upper <= total:
         cells[lower:upper]['mod'] = starting_module + mod - 1
-        center += mod * up_or_down * CELLS_PER_MODULE
-        lower = round(center - CELLS_PER_MODULE // 2)
-        upper = round(center + np.ceil(CELLS_PER_MODULE / 2))
+        center += mod * up_or_down * per_module
+        lower = round(center - per_module // 2)
+        upper = round(center + np.ceil(per_module / 2))
         mod += 1
         up_or_down *= -1
 
-    center += mod * up_or_down * CELLS_PER_MODULE
+    center += mod * up_or_down * per_module
 
     if lower < 0:
-        center += mod * up_or_down * CELLS_PER_MODULE
-        lower = round(center - CELLS_PER_MODULE // 2)
-        upper = round(center + np.ceil(CELLS_PER_MODULE / 2))
+        center += mod * up_or_down * per_module
+        lower = round(center - per_module // 2)
+        upper = round(center + np.ceil(per_module / 2))
         while upper <= total:
             cells[lower:upper]['mod'] = starting_module + mod - 1
-            center += CELLS_PER_MODULE
-            lower = round(center - CELLS_PER_MODULE // 2)
-            upper = round(center + np.ceil(CELLS_PER_MODULE / 2))
+            center += per_module
+            lower = round(center - per_module // 2)
+            upper = round(center + np.ceil(per_module / 2))
             mod += 1
     elif upper > total:
-        lower = round(center - CELLS_PER_MODULE // 2)
-        upper = round(center + np.ceil(CELLS_PER_MODULE / 2))
+        lower = round(center - per_module // 2)
+        upper = round(center + np.ceil(per_module / 2))
         while lower >= 0:
             cells[lower:upper]['mod'] = starting_module + mod - 1
-            center -= CELLS_PER_MODULE
-            lower = round(center - CELLS_PER_MODULE // 2)
-            upper = round(center + np.ceil(CELLS_PER_MODULE / 2))
+            center -= per_module
+            lower = round(center - per_module // 2)
+            upper = round(center + np.ceil(per_module / 2))
             mod += 1
 
     total_modules = mod - 1
             
     return cells, total_modules
 
-cells = read_cells(CELL_DATA_PATH)
-cells, bad_cells = process_cells(cells)
-cells, total_modules = assign_to_modules(cells, 1)
-
-# find cells that are not assigned to any module
-unused = cells[cells['mod'] == 0]
-cells = cells[cells['mod'] != 0]
-
-# add the bad cells to the unused list
-unused = np.concatenate((unused, bad_cells))
-unused = np.sort(unused, order='dist')
-unused, bad_modules = assign_to_modules(unused, total_modules + 1)
-total_modules += bad_modules
-
-cells_sorted = np.concatenate((cells, unused))
-
-plt.scatter(cells_sorted['mod'], cells_sorted['dist'])
-plt.xlabel('Module')
-plt.ylabel('Distance from median')
-plt.tight_layout()
-plt.savefig('deviations by module')
-
-np.savetxt('useless_details--NOT_important--DO_NOT_READ.csv', cells_sorted, delimiter=',', header='num,v0,st,lt,dev_st,dev_lt,dev,largest_dev,dist,abs_dist,mod', fmt='%i,%f,%f,%f,%f,%f,%f,%s,%f,%f,%i')
-
-with open ('module_list.txt', 'w') as file:
-    for mod in range(1, total_modules + 1):
-        file.write(f'Module {mod}: ')
-        cells_in_mod = [cell['num'] for cell in cells_sorted if cell['mod'] == mod]
-        cells_in_mod.sort()
-        file.write(', '.join(str(cell) for cell in cells_in_mod))
-        file.write('\n')
-    leftovers = [cell['num'] for cell in cells_sorted if cell['mod'] == 0]
-    if len(leftovers) > 0:
-        leftovers.sort()
-        file.write('Leftovers: ')
-        file.write(', '.join(str(cell) for cell in leftovers))
-
-with open ('cell_list.txt', 'w') as file:
-    cells_sorted.sort(order='num')
-    for cell in cells_sorted:
-        file.write(f'Cell {cell["num"]}: module {cell["mod"] if cell["mod"] != 0 else 'NONE'}\n')
-
-print(f'Modules generated: {total_modules}')
+def match_order(cells, keys, per_module=None):
+    # sorts by the first key, then regroups each band of BAND_MODULES ** n modules by the next key, and so on. bigger bands
+    # match the later keys more closely at the cost of the earlier ones
+    per_module = CELLS_PER_MODULE if per_module is None else per_module
+    keys = list(keys)
+    order = np.lexsort((cells['num'], cells[keys[0]]))
+    for level, key in enumerate(keys[1:]):
+        band = np.arange(len(order)) // (per_module * BAND_MODULES ** (len(keys) - 1 - level))
+        order = order[np.lexsort((cells['num'][order], cells[key][order], band))]
+    return order
+
+def window_spreads(cells, keys, scales=None, per_module=None):
+    # the range of each value over every run of per_module cells in a row, in standard deviations of the lot
+    # (or of scales if it's given), times its weight if keys is a dict of them. a module is only as well matched as
+    # its worst value
+    per_module = CELLS_PER_MODULE if per_module is None else per_module
+    weights = keys if isinstance(keys, dict) else dict.fromkeys(keys, 1.0)
+    spread = 0.0
+    for key, weight in weights.items():
+        scale = np.std(cells[key]) if scales is None else scales[key]
+        windows = np.lib.stride_tricks.sliding_window_view(cells[key], per_module)
+        spread = np.maximum(spread, weight * (windows.max(axis=1) - windows.min(axis=1)) / (scale or 1.0))
+    return spread
+
+def match_modules(cells, starting_module=1, keys=None, max_spread=None, scales=None, per_module=None):
+    # lines the cells up with match_order, then picks which runs of per_module cells in that order become modules.
+    # every module is worth 1 - spread / max_spread, and the dynamic program picks the modules worth the most in total,
+    # the smallest total spread between ones worth the same. so it leaves cells over rather than make a module that's
+    # badly matched, and can skip a cell so that the ones either side of it match better. with max_spread=np.inf
+    # every module is worth 1 and it makes as many as it can. it's exactly optimal when matching on one value, with
+    # several it's as good as the order match_order lines them up in
+    per_module = CELLS_PER_MODULE if per_module is None else per_module
+    keys = MATCH_KEYS if keys is None else keys
+    max_spread = MAX_SPREAD if max_spread is None else max_spread
+    limit = np.inf if max_spread is None else max_spread
+    k = per_module
+    cells = take(cells, match_order(cells, keys, k)) if len(cells) > 0 else cells.copy()
+    cells['mod'] = 0
+    if len(cells) < k:
+        return cells, 0
+    spread = window_spreads(cells, keys, scales, k)
+    worth = 1 - spread / limit
+
+    # best[i] is (total worth, -total spread) for the first i cells. every cell either ends a module or is skipped
+    best = [(0.0, 0.0)] * (len(cells) + 1)
+    ends_module = [False] * (len(cells) + 1)
+    spread_list = spread.tolist()
+    worth_list = worth.tolist()
+    for i in range(k, len(cells) + 1):
+        best[i] = best[i - 1]
+        if worth_list[i - k] > 0:
+            total, cost = best[i - k]
+            candidate = (total + worth_list[i - k], cost - spread_list[i - k])
+            if candidate > best[i]:
+                best[i] = candidate
+                ends_module[i] = True
+
+    starts = []
+    i = len(cells)
+    while i >= k:
+        if ends_module[i]:
+            starts.append(i - k)
+            i -= k
+        else:
+            i -= 1
+
+    # number the modules from the most typical cells outwards, like assign_to_modules does
+    starts = np.array(starts[::-1], dtype=int).reshape(-1)
+    typical = np.abs(cells['dist'][starts[:, None] + np.arange(k)]).mean(axis=1)
+    for mod, start in enumerate(starts[np.argsort(typical, kind='stable')]):
+        cells['mod'][start:start + k] = starting_module + mod
+    return cells, len(starts)
+
+def module_quality(cells, keys=('st', 'lt', 'v0')):
+    # the range of each value within every module, and how many cells are left over
+    modules = take(cells, cells['mod'] != 0)
+    modules = take(modules, np.lexsort((modules['num'], modules['mod'])))
+    quality = {'modules': len(np.unique(modules['mod'])), 'leftovers': int(np.sum(cells['mod'] == 0))}
+    if len(modules) == 0:
+        return quality
+    starts = np.flatnonzero(np.diff(modules['mod'], prepend=-1))
+    for key in keys:
+        ranges = np.maximum.reduceat(modules[key], starts) - np.minimum.reduceat(modules[key], starts)
+        quality[key] = {'median': float(np.median(ranges)), 'mean': float(np.mean(ranges)), 'max': float(np.max(ranges)), 'lot_std': float(np.std(cells[key]))}
+    return quality
+
+def print_quality(quality):
+    print(f'Modules: {quality["modules"]}, leftover cells: {quality["leftovers"]}')
+    for key in ['st', 'lt', 'v0']:
+        if key in quality:
+            q = quality[key]
+            print(f'{key:>3} spread within modules: median {q["median"]:.3e}, mean {q["mean"]:.3e}, worst {q["max"]:.3e} (lot standard deviation {q["lot_std"]:.3e})')
+
+def sort_cells(cells, plot=True, solver=None, per_module=None, exclude_sigma=None, fit_order=None, verbose=True):
+    # returns every cell with its module number, 0 if it's left over
+    cells, bad_cells = process_cells(cells, plot, per_module, exclude_sigma, fit_order, verbose)
+    return group_cells(cells, bad_cells, solver, per_module)
+
+def group_cells(cells, bad_cells, solver=None, per_module=None):
+    # matches the good cells into modules first, then whatever's left over together with the bad cells
+    solver = SOLVER if solver is None else solver
+    if solver == 'window':
+        # the spreads are measured against the whole lot in both passes, so a module is worth the same in either
+        lot = np.concatenate((cells, bad_cells))
+        scales = {key: np.std(lot[key]) for key in MATCH_KEYS}
+        assign = lambda cells, starting_module, per_module: match_modules(cells, starting_module, scales=scales, per_module=per_module)
+    else:
+        assign = assign_to_modules
+    cells, total_modules = assign(cells, 1, per_module=per_module)
+
+    # find cells that are not assigned to any module
+    unused = take(cells, cells['mod'] == 0)
+    cells = take(cells, cells['mod'] != 0)
+
+    # add the bad cells to the unused list
+    unused = np.concatenate((unused, bad_cells))
+    unused, bad_modules = assign(unused, total_modules + 1, per_module=per_module)
+    total_modules += bad_modules
+
+    return np.concatenate((cells, unused)), total_modules
+
+sweep_lot = None    # the parsed lot in each sweep process, sent once when the process starts instead of with every job
+
+def init_sweep(cells):
+    global sweep_lot
+    sweep_lot = cells
+
+def evaluate(combo):
+    # sorts the lot with one combination of settings, returns a row of the sweep table
+    exclude_sigma, per_module, solver = combo
+    cells, bad_cells = process_cells(sweep_lot, False, per_module, exclude_sigma, verbose=False)
+    cells_sorted, total_modules = group_cells(cells, bad_cells, solver, per_module)
+    quality = module_quality(cells_sorted)
+    row = {'exclude_sigma': exclude_sigma, 'cells_per_module': per_module, 'solver': solver,
+           'modules': total_modules, 'excluded': len(bad_cells), 'leftovers': quality['leftovers']}
+    for key in ['st', 'lt', 'v0']:
+        row[f'{key}_median'] = quality[key]['median'] if key in quality else float('nan')
+        row[f'{key}_max'] = quality[key]['max'] if key in quality else float('nan')
+    return row
+
+def sweep(cells, exclude_sigmas, module_sizes, solver=None, workers=None):
+    # every combination is sorted in its own process, the lot is only read and parsed once
+    combos = list(itertools.product(exclude_sigmas, module_sizes, [SOLVER if solver is None else solver]))
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_sweep, initargs=(cells,)) as pool:
+        return list(pool.map(evaluate, combos))
+
+def write_sweep(rows, filename='sweep.csv'):
+    with open(filename, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+
+def print_sweep(rows):
+    print(f'{"sigma":>6}{"size":>6}{"modules":>9}{"excluded":>10}{"leftovers":>11}{"st median":>12}{"lt median":>12}{"v0 median":>12}')
+    for row in rows:
+        print(f'{row["exclude_sigma"]:>6g}{row["cells_per_module"]:>6}{row["modules"]:>9}{row["excluded"]:>10}{row["leftovers"]:>11}'
+              f'{row["st_median"]:>12.3e}{row["lt_median"]:>12.3e}{row["v0_median"]:>12.3e}')
+
+def group_by_module(cells_sorted):
+    # the cell numbers in order with their modules, then the same cells grouped by module. a stable sort of the
+    # modules keeps the cells of each one in number order, so both lists come from one sort by number
+    by_num = np.argsort(cells_sorted['num'], kind='stable')
+    nums, mods = cells_sorted['num'][by_num], cells_sorted['mod'][by_num]
+    by_mod = np.argsort(mods, kind='stable')
+    return nums, mods, nums[by_mod], mods[by_mod]
+
+def write_module_list(cells_sorted, total_modules, filename='module_list.txt', groups=None):
+    _, _, nums, mods = group_by_module(cells_sorted) if groups is None else groups
+    starts = np.searchsorted(mods, np.arange(total_modules + 2))
+    with open (filename, 'w') as file:
+        for mod in range(1, total_modules + 1):
+            file.write(f'Module {mod}: ')
+            file.write(', '.join(str(num) for num in nums[starts[mod]:starts[mod + 1]]))
+            file.write('\n')
+        leftovers = nums[:starts[1]]
+        if len(leftovers) > 0:
+            file.write('Leftovers: ')
+            file.write(', '.join(str(num) for num in leftovers))
+            file.write('\n')
+
+def write_cell_list(cells_sorted, filename='cell_list.txt', groups=None):
+    nums, mods, _, _ = group_by_module(cells_sorted) if groups is None else groups
+    with open (filename, 'w') as file:
+        file.writelines(f'Cell {num}: module {mod if mod != 0 else "NONE"}\n' for num, mod in zip(nums.tolist(), mods.tolist()))
+
+def hash_files(paths, sha=None):
+    sha = hashlib.sha1() if sha is None else sha
+    for path in paths:
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+def fingerprint(csv_path, args):
+    # changes if the results, anything that changes how the cells are sorted, or cellect.py itself does
+    settings = {'cells_per_module': args.cells_per_module[0], 'exclude_sigma': args.exclude_sigma[0], 'fit_order': args.fit_order,
+                'solver': args.solver, 'plots': not args.no_plots, 'match_keys': MATCH_KEYS, 'band_modules': BAND_MODULES, 'max_spread': MAX_SPREAD}
+    return hash_files([csv_path, __file__], hashlib.sha1(json.dumps(settings, sort_keys=True).encode()))
+
+def up_to_date(key, plots=True):
+    # the fingerprint file has the inputs' fingerprint and then the outputs', so an output that's been changed or
+    # appended to since (by hand, or by another script) gets written again too
+    if not os.path.exists(FINGERPRINT_PATH) or not all(os.path.exists(path) for path in OUTPUTS + (PLOTS if plots else [])):
+        return False
+    with open(FINGERPRINT_PATH, 'r') as file:
+        return file.read().split() == [key, hash_files(OUTPUTS)]
+
+def main(args):
+    if args.sweep:
+        rows = sweep(read_cells(args.csv), args.exclude_sigma, args.cells_per_module, args.solver, args.workers)
+        print_sweep(rows)
+        write_sweep(rows)
+        return
+    key = fingerprint(args.csv, args)
+    if not args.force and up_to_date(key, not args.no_plots):
+        print(f'{args.csv} and the settings are the same as last time, the module list is up to date. Use --force to sort it again.')
+        return
+    if os.path.exists(FINGERPRINT_PATH):
+        os.remove(FINGERPRINT_PATH)     # so a run that's stopped part way through doesn't leave the old outputs looking current
+
+    cells = read_cells(args.csv)
+    cells_sorted, total_modules = sort_cells(cells, not args.no_plots, args.solver, args.cells_per_module[0],
+                                             args.exclude_sigma[0], args.fit_order)
+
+    if not args.no_plots:
+        plt = pyplot()
+        plt.scatter(cells_sorted['mod'], cells_sorted['dist'])
+        plt.xlabel('Module')
+        plt.ylabel('Distance from median')
+        plt.tight_layout()
+        plt.savefig('deviations by module')
+
+    np.savetxt('useless_details--NOT_important--DO_NOT_READ.csv', cells_sorted, delimiter=',', header='num,v0,st,lt,dev_st,dev_lt,dev,largest_dev,dist,abs_dist,mod', fmt='%i,%f,%f,%f,%f,%f,%f,%s,%f,%f,%i')
+
+    groups = group_by_module(cells_sorted)
+    write_module_list(cells_sorted, total_modules, groups=groups)
+    write_cell_list(cells_sorted, groups=groups)
+
+    print_quality(module_quality(cells_sorted))
+    print(f'Modules generated: {total_modules}')
+    with open(FINGERPRINT_PATH, 'w') as file:
+        file.write(key + '\n' + hash_files(OUTPUTS) + '\n')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sort tested cells into matched modules.')
+    parser.add_argument('csv', nargs='?', default=CELL_DATA_PATH, help='the CSV goodLab.py writes results to')
+    parser.add_argument('--exclude-sigma', type=float, nargs='+', default=[EXCLUDE_SIGMA], help='dev_st cutoff in standard deviations')
+    parser.add_argument('--fit-order', type=int, default=FIT_ORDER, help="order of the fit of long term resistance against v0, it only changes dev_lt so --sweep doesn't vary it")
+    parser.add_argument('--cells-per-module', type=int, nargs='+', default=[CELLS_PER_MODULE])
+    parser.add_argument('--solver', choices=['window', 'greedy'], default=SOLVER, help='how to match cells into modules')
+    parser.add_argument('--sweep', action='store_true', help='try every combination of the values given and write sweep.csv instead of the module list')
+    parser.add_argument('--workers', type=int, help='number of processes for --sweep, defaults to one per CPU')
+    parser.add_argument('--no-plots', action='store_true', help="don't draw the dev_st distribution and deviations by module plots")
+    parser.add_argument('--force', action='store_true', help='sort the cells again even if nothing has changed')
+    main(parser.parse_args())
@@ -0,0 +1,172 @@
+import argparse
+import os
+from time import sleep
+import numpy as np
+import cellect
+
+# builds modules while the lot is still being tested, so pack assembly doesn't have to wait for the last cell.
+# it follows the CSV goodLab.py appends to, keeps every cell that isn't in a module yet in a holding pool, and closes a
+# module as soon as the pool has CELLS_PER_MODULE cells that match well enough. closed modules are appended to
+# stream_module_list.txt and stream_cell_list.txt straight away and never change after that. run it again and it
+# carries on from the modules already in stream_module_list.txt. it has its own files so it never mixes its modules
+# with the ones cellect.py writes to module_list.txt.
+#   python cellstream.py                    follow G7_2023.csv until Ctrl+C
+#   python cellstream.py --once             read what's there, close what it can and stop
+#   python cellstream.py --once --finish    the lot is done: put the rest of the pool into modules like cellect.py does
+
+MODULE_LIST = 'stream_module_list.txt'
+CELL_LIST = 'stream_cell_list.txt'
+STREAM_KEYS = {'lt': 1.0, 'st': 0.25}   # what modules are matched on while the lot is tested, and each one's weight. fewer
+                                        # keys than cellect.MATCH_KEYS, since every key added makes a close match rarer
+STREAM_SPREAD = 0.5     # the most a weighted value may vary within a module, in standard deviations of the cells tested
+                        # so far. on G7_2023.csv fed in a row at a time, 36 of 50 modules close before the last cell
+                        # is tested, 15 of them by cell 300. raising it closes more of them early but less well matched
+MIN_CELLS = 4 * cellect.CELLS_PER_MODULE   # cells to wait for before closing any module, so there's a choice of matches
+POLL_S = 1
+
+def append_lines(path:str, lines:list):
+    # starts a new line first if something left the file without one, so a line is never run onto the end of another
+    if len(lines) == 0:
+        return
+    with open(path, 'a+b') as file:
+        if file.tell() > 0:
+            file.seek(-1, os.SEEK_END)
+            if file.read(1) != b'\n':
+                file.write(b'\n')
+        file.write(''.join(lines).encode())
+
+class CellStream:
+    def __init__(self, csv_path:str, module_list:str = MODULE_LIST, cell_list:str = CELL_LIST):
+        self.csv_path = csv_path
+        self.module_list = module_list
+        self.cell_list = cell_list
+        self.offset = 0
+        self.partial = ''       # the end of a row goodLab.py hasn't finished writing
+        self.columns = None
+        self.cells = {}         # num: (v0, st, lt) for every cell read so far
+        self.pool = {}          # the cells that aren't in a module yet
+        self.modules = {}       # num: module for the cells in closed modules
+        self.next_module = 1
+        self.resume()
+
+    def resume(self):
+        # picks up the modules a previous run already closed
+        if not os.path.exists(self.module_list):
+            return
+        with open(self.module_list, 'r') as file:
+            for line in file:
+                if line.startswith('Module '):
+                    name, nums = line.split(':', 1)
+                    mod = int(name.split()[1])
+                    for num in nums.split(','):
+                        if num.strip() != '':
+                            self.modules[int(num)] = mod
+                    self.next_module = max(self.next_module, mod + 1)
+
+    def read_new_rows(self):
+        # reads whatever has been appended to the CSV since last time, returns how many cells were added to the pool
+        if not os.path.exists(self.csv_path):
+            return 0
+        with open(self.csv_path, 'r') as file:
+            file.seek(self.offset)
+            data = file.read()
+            self.offset = file.tell()
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        added = 0
+        for line in lines:
+            values = line.strip().split(',')
+            if values == ['']:
+                continue
+            if self.columns is None:
+                self.columns = [values.index(name) for name in ['num', 'v0', 'res_st', 'res_lt']]
+                continue
+            num, v0, res_st, res_lt = (values[column] for column in self.columns)
+            num = int(num)
+            cell = (float(v0), float(res_st), float(res_lt) - float(res_st))
+            if num in self.modules:
+                if num in self.cells:
+                    print(f'Cell {num} was tested again but it is already in module {self.modules[num]}. Check which result is valid.')
+            else:
+                if num in self.pool:
+                    print(f'Cell {num} was tested again, using the latest result.')
+                self.pool[num] = cell
+                added += 1
+            self.cells[num] = cell
+        return added
+
+    def pool_array(self):
+        # the pool in the layout cellect.match_modules works on, with dist measured from the median of every cell so far
+        nums = np.fromiter(self.pool.keys(), dtype='i8', count=len(self.pool))
+        values = np.array(list(self.pool.values()), dtype=float).reshape(-1, 3)
+        pool = np.zeros(len(nums), dtype=cellect.SORTED_DTYPE)
+        pool['num'] = nums
+        pool['v0'] = values[:, 0]
+        pool['st'] = values[:, 1]
+        pool['lt'] = values[:, 2]
+        everything = np.array(list(self.cells.values()), dtype=float).reshape(-1, 3)
+        pool['dist'] = pool['lt'] - np.median(everything[:, 2])
+        pool['abs_dist'] = np.abs(pool['dist'])
+        scales = {key: np.std(everything[:, column]) for column, key in enumerate(['v0', 'st', 'lt'])}
+        return pool, scales
+
+    def close_modules(self, finish:bool = False):
+        # closes every module the pool can make that's matched to within STREAM_SPREAD. finish closes as many as it can
+        # however well they match, like the second pass in cellect.sort_cells. returns {module: [cell numbers]}
+        if len(self.pool) < (cellect.CELLS_PER_MODULE if finish else MIN_CELLS):
+            return {}
+        pool, scales = self.pool_array()
+        pool, count = cellect.match_modules(pool, self.next_module, keys=STREAM_KEYS, max_spread=np.inf if finish else STREAM_SPREAD, scales=scales)
+        closed = {mod: [] for mod in range(self.next_module, self.next_module + count)}
+        for num, mod in zip(pool['num'].tolist(), pool['mod'].tolist()):
+            if mod != 0:
+                closed[mod].append(num)
+        for mod, nums in closed.items():
+            nums.sort()
+            for num in nums:
+                self.modules[num] = mod
+                del self.pool[num]
+        self.next_module += count
+        self.write(closed)
+        return closed
+
+    def write(self, closed:dict):
+        # appends the new modules, the lines already in the files stay as they are so the assembly line can trust them
+        append_lines(self.module_list, [f'Module {mod}: ' + ', '.join(str(num) for num in nums) + '\n' for mod, nums in closed.items()])
+        append_lines(self.cell_list, [f'Cell {num}: module {mod}\n' for mod, nums in closed.items() for num in nums])
+
+    def write_leftovers(self):
+        leftovers = sorted(self.pool)
+        if len(leftovers) == 0:
+            return
+        append_lines(self.module_list, ['Leftovers: ' + ', '.join(str(num) for num in leftovers) + '\n'])
+        append_lines(self.cell_list, [f'Cell {num}: module NONE\n' for num in leftovers])
+
+    def update(self, finish:bool = False):
+        if self.read_new_rows() > 0 or finish:
+            for mod, nums in self.close_modules(finish).items():
+                print(f'Module {mod}: ' + ', '.join(str(num) for num in nums))
+        return len(self.pool)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Assign cells to modules while the lot is being tested.')
+    parser.add_argument('csv', nargs='?', default=cellect.CELL_DATA_PATH, help='the CSV goodLab.py writes results to')
+    parser.add_argument('--once', action='store_true', help="read the CSV once instead of following it")
+    parser.add_argument('--finish', action='store_true', help='the lot is finished, put the rest of the pool into modules')
+    parser.add_argument('--module-list', default=MODULE_LIST, help="where the closed modules go, don't use cellect.py's module_list.txt")
+    parser.add_argument('--cell-list', default=CELL_LIST)
+    args = parser.parse_args()
+
+    stream = CellStream(args.csv, args.module_list, args.cell_list)
+    try:
+        while True:
+            stream.update()
+            if args.once:
+                break
+            sleep(POLL_S)
+    except KeyboardInterrupt:
+        pass
+    if args.finish:
+        stream.update(finish=True)
+        stream.write_leftovers()
+    print(f'{len(stream.modules) // cellect.CELLS_PER_MODULE} modules closed, {len(stream.pool)} cells waiting for a match')
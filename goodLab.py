@@ -1,10 +1,21 @@
-from time import sleep
+from time import sleep, perf_counter
+from contextlib import contextmanager
 import pyvisa
 import os
 import csv
 from datetime import datetime
 import sys
 import subprocess
+import json
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import queue
+import math
+from bisect import bisect_left, insort
+import numpy as np
+import analysis
+from results import ResultStore
 
 Settings = {
     "group_name" : "G7_2023",
@@ -19,8 +30,19 @@ Settings = {
     "v_channel" : 1,    # which Oscope channel is measuring cell voltage?
     "i_channel" : 2,    # which Oscope channel is connected to current monitor output on the load?
     "i_scale_factor" : 2.86,   # scale factor for current monitor output from load
+    "use_result_db" : True,     # keep results in <group_name>.db as well as the CSV, so startup doesn't parse every row. it ranks in O(log n) like Ranking, after reading the resistance indexes once
+    "pipelined" : False,    # save waveforms and results in the background so the next cell can be set up while that happens
+    "check_scope_state" : False,    # read the scope's settings with SET? at startup and after recalling a setup, so we don't re-send ones that are already right
+    "check_load_list" : True,   # ask the load how its list is set up at startup, so a list that's already programmed isn't sent again
+    "local_analysis" : False,   # pull the V and I waveforms off the scope once per cell and find the edges and resistances here instead of with the scope's search and cursors
+    "spectrum" : False,     # with local_analysis, also work out each cell's impedance spectrum from the same waveforms and save it to <group_name>_spectrum.csv
+    "spectrum_bands" : [0.1, 1000, 12],     # [lowest Hz, highest Hz, number of bands] for the spectrum
+    "archive_path" : None,      # with local_analysis, also keep the waveforms in this archive folder (see archive.py)
 
-    "default_res" : 50e-3
+    "default_res" : 50e-3,
+    "probe_timeout_ms" : 500,   # how long to wait for each instrument to answer while we're looking for them
+    "stations" : 1,     # how many load/scope pairs to test cells on at once. 0 uses every pair we can find
+    "station_pairs" : [],   # [[load resource, scope resource], ...] to choose the pairs, otherwise they're paired in the order VISA lists them
 }
 
 def debug(str, forcePrint = False):
@@ -29,10 +51,85 @@ def debug(str, forcePrint = False):
         print(str)
     return
 
+class Logger:
+    # writes log.txt (and the timing records in log.jsonl) from a background thread, keeping the files open and
+    # flushing every so often, so logging every command doesn't mean opening a file for every line
+    def __init__(self, path:str = 'log.txt', records_path:str = 'log.jsonl', flush_interval:float = 1.0):
+        self.path = path
+        self.records_path = records_path
+        self.flush_interval = flush_interval
+        self.lines = queue.Queue()
+        self.thread = None
+        self.start_lock = threading.Lock()      # the probe threads can all log their first line at once
+
+    def write(self, filename:str, line:str):
+        if self.thread is None:     # start the thread the first time we log something, not when goodLab is imported
+            with self.start_lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run, daemon=True)
+                    self.thread.start()
+                    atexit.register(self.close)
+        self.lines.put((filename, line))
+
+    def log(self, line:str):
+        self.write(self.path, line)
+
+    def record(self, record:dict):
+        self.write(self.records_path, json.dumps(record))
+
+    def run(self):
+        files = {}
+        last_flush = perf_counter()
+        running = True
+        while running:
+            try:
+                item = self.lines.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = ()
+            while item is not None:     # write everything that's waiting before flushing
+                if item != ():
+                    filename, line = item
+                    if filename not in files:
+                        files[filename] = open(filename, 'a')
+                    files[filename].write(f'{line}\n')
+                try:
+                    item = self.lines.get_nowait()
+                except queue.Empty:
+                    break
+            if item is None:
+                running = False
+            if not running or perf_counter() - last_flush >= self.flush_interval:
+                for file in files.values():
+                    file.flush()
+                last_flush = perf_counter()
+        for file in files.values():
+            file.close()
+
+    def close(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.lines.put(None)
+            self.thread.join()
+
+logger = Logger()
+
 def log(str):
     dt_str = datetime.now().strftime("%Y-%m-%d  %H:%M:%S")
-    with open("log.txt", "a") as logFile:
-        logFile.write(f'{dt_str}: {str}\n')
+    logger.log(f'{dt_str}: {str}')
+
+@contextmanager
+def span(instrument:str, command:str):
+    # times one transaction with an instrument and writes it to log.jsonl. fill in the reply (and retries, if any)
+    # on the record this yields. the scope adds polls, how many times it asked whether the commands were done
+    record = {'time': datetime.now().isoformat(), 'instrument': instrument, 'command': command, 'reply': None, 'retries': 0}
+    start = perf_counter()
+    try:
+        yield record
+    except Exception as err:
+        record['error'] = f'{err}'
+        raise
+    finally:
+        record['duration'] = perf_counter() - start
+        logger.record(record)
 
 def errors(str_list, source = ''):
     for str in str_list:
@@ -40,69 +137,250 @@ def errors(str_list, source = ''):
         debug(str, True)
     return
 
-class Load:
+def backoff(timeout:float, first_delay:float = 0.001, max_delay:float = 0.1):
+    # for polling the instruments: sleeps a little longer each time round the loop, and stops once we've waited
+    # for timeout seconds. use it with for/else, the else block runs if we ran out of time
+    waited = 0
+    delay = first_delay
+    while waited < timeout:
+        sleep(delay)
+        waited += delay
+        yield waited
+        delay = min(delay * 2, max_delay)
+
+def join_commands(commands:list):
+    # commands after the first one get a leading colon so the instrument reads each header from the root
+    # instead of relative to the previous command's header. common commands like *OPC don't need it
+    msg = commands[0]
+    for cmd in commands[1:]:
+        if cmd.startswith('*') or cmd.startswith(':'):
+            msg += f';{cmd}'
+        else:
+            msg += f';:{cmd}'
+    return msg
+
+# commands that do something rather than change a setting, so they always get sent
+UNCACHED = ['*', 'INP', 'SAVE:', 'FILES:', 'RECALL:', 'ACQUIRE:STATE', 'SEARCH:SEARCH1:NAV']
+# commands that change settings behind our back, so we forget everything we know about the instrument
+INVALIDATES = ['*RST', '*RCL', 'RECALL:']
+
+def setting_key(cmd:str):
+    # splits a command like "LIST:LEVel 1, 10" into the setting it changes ("LIST:LEVEL 1") and the value it sets it to (10.0).
+    # returns None, None for commands that aren't settings
+    header, _, args = cmd.strip().partition(' ')
+    header = header.lstrip(':').upper()
+    if args.strip() == '' or header.endswith('?') or any(header.startswith(prefix) for prefix in UNCACHED):
+        return None, None
+    args = [arg.strip() for arg in args.split(',')]
+    return ' '.join([header] + args[:-1]), setting_value(args[-1])
+
+def setting_value(value_str:str):
+    try:
+        return float(value_str)     # so 2.5E+0 and 2.50 count as the same thing
+    except ValueError:
+        return value_str.strip('"').upper()
+
+def parse_settings(settings_str:str):
+    # turns a reply to SET? (":CH1:SCALE 1.0E+0;:CH1:POSITION 0;...") into the same keys and values setting_key() gives us
+    state = {}
+    path = ''
+    for cmd in settings_str.strip().split(';'):
+        if cmd.strip() == '':
+            continue
+        if not cmd.startswith(':') and not cmd.startswith('*') and path != '':
+            cmd = path + cmd    # no leading colon means it's relative to the previous header
+        key, value = setting_key(cmd)
+        header = cmd.lstrip(':').partition(' ')[0]
+        if ':' in header:
+            path = header[:header.rindex(':') + 1]
+        if key is not None:
+            state[key] = value
+    return state
+
+shadow_states = {}      # last value we wrote for each setting, per instrument, so it survives making a new Load or Oscope
+
+class Instrument:
+    max_batch = 16      # keep each message well under the instrument's input buffer size
+
+    def __init__(self, resource):
+        self.pending = None      # commands waiting to be sent, or None when we're not batching
+        self.pending_state = {}     # the settings those commands make, they only go into self.state once they're sent
+        self.lock = threading.RLock()   # the result worker can talk to the scope while the main loop is using it
+        self.state = shadow_states.setdefault(getattr(resource, 'resource_name', id(resource)), {})
+
+    def unchanged(self, str:str):
+        key, value = setting_key(str)
+        if key is None:
+            return False
+        if key in self.pending_state:
+            return self.pending_state[key] == value
+        return key in self.state and self.state[key] == value
+
+    def invalidate(self):
+        self.state.clear()
+
+    # inside a "with instr.batch():" block, writes are collected and sent as one message when the block ends,
+    # so we only pay for the error check / OPC handshake once per group of commands instead of once per command
+    @contextmanager
+    def batch(self):
+        with self.lock:
+            if self.pending is not None:    # we're already inside a batch, so the outer one will send everything
+                yield self
+                return
+            self.pending = []
+            self.pending_state = {}
+            try:
+                yield self
+                self.flush()
+            finally:
+                self.pending = None     # if the block raised, nothing it wrote was sent, so none of it goes in self.state
+                self.pending_state = {}
+
+    def write(self, str:str):
+        with self.lock:
+            if self.unchanged(str):    # it's already set to that, no point sending it again
+                debug(f'    skipping (already set): {str}')
+                return False
+            if any(str.lstrip(':').upper().startswith(cmd) for cmd in INVALIDATES):
+                self.invalidate()
+                self.pending_state = {}     # the settings queued before it won't last either
+            key, value = setting_key(str)
+            if self.pending is None:
+                return self.checked_send([str], {key: value} if key is not None else {})
+            if key is not None:
+                self.pending_state[key] = value
+            self.pending.append(str)
+            if len(self.pending) >= self.max_batch:
+                self.flush()
+            return False
+
+    def flush(self):
+        if not self.pending:
+            return False
+        commands, updates = self.pending, self.pending_state
+        self.pending, self.pending_state = [], {}
+        return self.checked_send(commands, updates)
+
+    def checked_send(self, commands:list, updates:dict):
+        # the settings only count as made once they've been sent. if sending fails part way (a timeout, or the load
+        # not answering) we don't know which of them the instrument got, so they're forgotten and sent again next time
+        try:
+            are_errors = self.send(commands)
+        except Exception:
+            for key in updates:
+                self.state.pop(key, None)
+            raise
+        if are_errors:      # we don't know which command failed, so we don't know what it's set to any more
+            self.invalidate()
+        else:
+            self.state.update(updates)
+        return are_errors
+
+class Load(Instrument):
     def __init__(self, load_res):
+        super().__init__(load_res)
         self.load_res = load_res
 
-        self.write('*RST')      # reset to default settings
-        self.write('FUNCtion:MODE FIXed')       # it has to be in fixed mode to set up the list
-        self.write('FUNCtion CURRent')      # set to constant current mode
-        self.write('CURRent 0')     # set current to 0 A so we don't have current flowing before we start running through the list
-        self.write('LIST:SLOWrate 0')    # this determines the units for the slew rate. 0: A/us, 1: A/ms
+        program = ['FUNCtion:MODE FIXed',       # it has to be in fixed mode to set up the list
+                   'FUNCtion CURRent',      # set to constant current mode
+                   'CURRent 0',     # set current to 0 A so we don't have current flowing before we start running through the list
+                   'LIST:SLOWrate 0']    # this determines the units for the slew rate. 0: A/us, 1: A/ms
         irange = max(Settings['i_sequence'][0])    # set the range so that it includes the max current we want
-        self.write(f'LIST:RANGE {irange}')
-        self.write('LIST:COUNt 1')      # we only want to run through the list 1 time
+        program.append(f'LIST:RANGE {irange}')
+        program.append('LIST:COUNt 1')      # we only want to run through the list 1 time
         num_steps = len(Settings['i_sequence'][0])   # number of steps in the list
-        self.write(f'LIST:STEP {num_steps + 1}')
+        program.append(f'LIST:STEP {num_steps + 1}')
         for i in range(1, num_steps + 1):
-            self.write(f"LIST:LEVel {i}, {Settings['i_sequence'][0][i-1]}")     # amplitude (A)
-            self.write(f"LIST:WIDth {i}, {Settings['i_sequence'][1][i-1]}")     # duration (s)
-            self.write(f"LIST:SLEW:BOTH {i}, {Settings['slew_rate']}")        # slew rate (A/us)
-        self.write(f"LIST:LEVel {num_steps + 1}, 0")
-        self.write(f"LIST:WIDth {num_steps + 1}, 0.1")
-        self.write(f"LIST:SLEW:BOTH {num_steps + 1}, {Settings['slew_rate']}")
-        
-        self.write('FUNCtion:MODE LIST')    # now we can switch to list mode
-        self.write('TRIGger:SOURce BUS')    # we want to trigger the load over VISA
+            program.append(f"LIST:LEVel {i}, {Settings['i_sequence'][0][i-1]}")     # amplitude (A)
+            program.append(f"LIST:WIDth {i}, {Settings['i_sequence'][1][i-1]}")     # duration (s)
+            program.append(f"LIST:SLEW:BOTH {i}, {Settings['slew_rate']}")        # slew rate (A/us)
+        program.append(f"LIST:LEVel {num_steps + 1}, 0")
+        program.append(f"LIST:WIDth {num_steps + 1}, 0.1")
+        program.append(f"LIST:SLEW:BOTH {num_steps + 1}, {Settings['slew_rate']}")
+        program.append('FUNCtion:MODE LIST')    # now we can switch to list mode
+        program.append('TRIGger:SOURce BUS')    # we want to trigger the load over VISA
 
-    def write(self, str:str):
-        debug(f'    sending to load: {str}')
-        done = False
-        while not done:
-            try:
-                self.load_res.write(str)
-                sleep(0.2)
-            except Exception as oops:
-                log(f"{oops}: {type(oops)}\r\n")
-                sleep(0.2)
-                continue
-            else:
-                done = True
-        err = self.ll_query('SYSTem:ERRor?').split(',')
-        while (err[0] != '0'):
-            errors(err, 'load')
-            err = self.ll_query('SYSTem:ERRor?')
+        if Settings['check_load_list']:
+            self.read_list(program[1:])
+        # FUNCtion:MODE goes from FIXed to LIST, so the list is only already set up if the load is in list mode
+        if all(self.unchanged(cmd) for cmd in program[1:]):
+            debug('Load list is already programmed.')
+            return
+        self.write('*RST')      # reset to default settings
+        with self.batch():
+            for cmd in program:
+                self.write(cmd)
+
+    def read_list(self, program:list):
+        # asks the load for every setting in program ("LIST:LEVel 1, 10" is asked as "LIST:LEVEL? 1") and puts the
+        # answers in self.state. if it doesn't answer one of them we leave it, and the list just gets sent again
+        keys = list(dict.fromkeys(key for key, _ in map(setting_key, program) if key is not None))
+        for start in range(0, len(keys), self.max_batch):
+            chunk = keys[start:start + self.max_batch]
+            queries = [key.replace(' ', '? ', 1) if ' ' in key else key + '?' for key in chunk]
+            replies = self.ll_query(join_commands(queries)).strip().split(';')
+            if len(replies) != len(chunk):
+                debug('    load did not answer every list query')
+                while int(self.ll_query('SYSTem:ERRor?').split(',')[0]) != 0:     # don't leave the errors for the next send
+                    pass
+                return
+            for key, reply in zip(chunk, replies):
+                self.state[key] = setting_value(reply)
+
+    def send(self, commands:list):
+        msg = join_commands(commands)
+        debug(f'    sending to load: {msg}')
+        with span('load', msg) as record:
+            self.retry(record, self.load_res.write, msg)
+            # the load handles commands in order, so once it answers the error query it's done with the ones we sent
+            are_errors = False
+            err = self.ll_query('SYSTem:ERRor?').split(',')
+            while (int(err[0]) != 0):     # keep reading until the error queue is empty, a batch can leave more than one error
+                are_errors = True
+                errors(err, 'load')
+                err = self.ll_query('SYSTem:ERRor?').split(',')
+            record['reply'] = 'errors' if are_errors else 'ok'
+        return are_errors
 
     def ll_query(self, str:str):
-        done = False
         debug(f'    asking load: {str}')
-        while not done:
+        with span('load', str) as record:
+            reply = self.retry(record, self.load_res.query, str)
+            record['reply'] = reply.strip()
+        debug(f'    load replied: {reply}')
+        return reply
+
+    def retry(self, record:dict, func, *args):
+        # the load doesn't always answer the first time, so keep trying for a while before giving up
+        try:
+            with self.lock:
+                return func(*args)
+        except Exception as oops:
+            log(f"{oops}: {type(oops)}\r\n")
+            error = oops
+        for _ in backoff(10, 0.05, 1):
+            record['retries'] += 1
             try:
-                reply = self.load_res.query(str)
-                sleep(0.2)
+                with self.lock:
+                    return func(*args)
             except Exception as oops:
                 log(f"{oops}: {type(oops)}\r\n")
-                sleep(0.2)
-                continue
-            else:
-                done = True
-        debug(f'    load replied: {reply}')
-        return reply
+                error = oops
+        raise error
+
+    def list_done(self):
+        # the list always ends with a 0 A step, so once the current has dropped back to zero it's finished
+        return abs(self.i()) < min(abs(i) for i in Settings['i_sequence'][0] if i != 0) / 2
 
     def trigger(self):
         self.write('INP 1')     # we have to enable input, otherwise it'll run through the list but not actually draw any current
         self.write('*TRG')    # this starts the list
-        sleep(sum(Settings['i_sequence'][1]) + 2)   # wait for the list to finish
+        sleep(sum(Settings['i_sequence'][1]))   # it can't be done before this, so there's no point asking
+        for _ in backoff(2, 0.02, 0.2):
+            if self.list_done():
+                break
+        else:
+            errors(["List didn't finish in time."], 'load')
         self.write('INP 0')    # disable input again just to be safe
 
     def i(self):
@@ -113,30 +391,44 @@ class Load:
         v = float(self.ll_query('FETCh:VOLTage?'))
         return v
     
-class Oscope:
+class Oscope(Instrument):
     def __init__(self, scope_res):
+        super().__init__(scope_res)
         self.scope_res = scope_res
         self.prev_settings = self.get_current_settings()
+        if Settings['check_scope_state']:
+            self.state.update(parse_settings(self.prev_settings))
 
-    def write(self, str:str):
-        debug(f'    sending to scope: {str}')
-        self.scope_res.write(str)
-        self.scope_res.write('*OPC')    # tell it to let us know when it's done processing the command
-        are_errors = done = False
-        while not done:
-            sleep(0.1)
-            esr = int(self.ll_query('*ESR?'))    # check the event status register (this also clears it)
-            if esr & 0b00111100 != 0:   # bits 2-5 represent errors
+    def send(self, commands:list):
+        msg = join_commands(commands + ['*OPC'])    # *OPC tells it to let us know when it's done processing the commands
+        debug(f'    sending to scope: {msg}')
+        with span('scope', msg) as record:
+            record['polls'] = 0
+            with self.lock:
+                self.scope_res.write(msg)
+            are_errors = False
+            for _ in backoff(30):     # saving waveforms can take a while, most commands are done in a few ms
+                record['polls'] += 1      # number of times we had to ask whether it was done
+                esr = int(self.ll_query('*ESR?'))    # check the event status register (this also clears it)
+                if esr & 0b00111100 != 0:   # bits 2-5 represent errors
+                    are_errors = True
+                    errs = self.ll_query('ALLEV?')   # get the error messages
+                    errs = errs.split(',')
+                    errors(errs, 'scope')
+                if esr & 0b1:  # when bit 0 is set it means it's finished processing the command
+                    break
+            else:
+                errors([f'Timed out waiting for the scope to finish: {msg}'], 'scope')
                 are_errors = True
-                errs = self.ll_query('ALLEV?')   # get the error messages
-                errs = errs.split(',')
-                errors(errs, 'scope')
-            done = bool(esr & 0b1)  # when bit 0 is set it means it's finished processing the command
+            record['reply'] = 'errors' if are_errors else 'ok'
         return are_errors
     
     def ll_query(self, str:str):
         debug(f'    asking scope: {str}')
-        reply = self.scope_res.query(str)
+        with span('scope', str) as record:
+            with self.lock:
+                reply = self.scope_res.query(str)
+            record['reply'] = reply.strip()
         debug(f'    scope replied: {reply}')
         return reply
     
@@ -146,7 +438,9 @@ class Oscope:
     def restore_settings(self, settings = ''):
         if settings == '':
             settings = self.prev_settings
-        self.scope_res.write(settings)
+        with self.lock:
+            self.scope_res.write(settings)
+            self.invalidate()
     
     def query_value(self, scpi_str:str):
         reply_str = self.ll_query(scpi_str)
@@ -160,28 +454,45 @@ class Oscope:
     def times_triggered(self):
         return int(self.ll_query('ACQuire:NUMACq?'))
 
+    def wait_until_ready(self, timeout:float = 5):
+        # changing settings restarts the acquisition, and the scope can't trigger until it's captured the pre-trigger part again
+        for _ in backoff(timeout, 0.01, 0.2):
+            if self.ll_query('TRIGger:STATE?').strip().upper().startswith('READY'):
+                return True
+        return False
+
+    def wait_for_acquisition(self, times:int, timeout:float = 5):
+        # waits until the acquisition that started after times_triggered() returned times has been captured
+        for _ in backoff(timeout, 0.01, 0.2):
+            if self.times_triggered() > times:
+                return True
+        return False
+
     def set_acq_duration_s(self, secs:float):
         secs = secs + 1
         sec_per_div = secs / 10
-        self.write(f'HORizontal:MODE:SCAle {sec_per_div:.13E}')
-        self.write(f'HORizontal:POSition {(100 * 0.5 / secs):.13E}')    # set the trigger position to 50% of the way through the acquisition
+        with self.batch():
+            self.write(f'HORizontal:MODE:SCAle {sec_per_div:.13E}')
+            self.write(f'HORizontal:POSition {(100 * 0.5 / secs):.13E}')    # set the trigger position to 50% of the way through the acquisition
 
     def set_v_range(self, channel:int, v_min:float, v_max:float):
         v_range = v_max - v_min
         v_per_div = v_range / 10
-        self.write(f'CH{channel}:SCAle {v_per_div:.13E}')
         pos_offset = -1 * (5 + v_min / v_per_div)
-        if -10 < pos_offset < 10:
-            self.write(f'CH{channel}:POSition {-1 * (5 + v_min / v_per_div)}')
-        else:
-            self.write(f'CH{channel}:OFFSET {(v_range / 2 + v_min):.13E}')
+        with self.batch():
+            self.write(f'CH{channel}:SCAle {v_per_div:.13E}')
+            if -10 < pos_offset < 10:
+                self.write(f'CH{channel}:POSition {-1 * (5 + v_min / v_per_div)}')
+            else:
+                self.write(f'CH{channel}:OFFSET {(v_range / 2 + v_min):.13E}')
 
     def measure_resistance_at(self, step:int, freq:float):
         actual_time = self.actual_t_values[step]
         a_time = actual_time - (self.di[step] / (Settings["slew_rate"] * 1e6)) / 2 - (1 / freq)
         b_time = actual_time + (self.di[step] / (Settings["slew_rate"] * 1e6)) / 2 + (1 / freq)
-        self.write(f'DISplay:WAVEView1:CURSor:CURSOR1:VBArs:APOSition {a_time:.13E}')
-        self.write(f'DISplay:WAVEView1:CURSor:CURSOR1:VBArs:BPOSition {b_time:.13E}')
+        with self.batch():
+            self.write(f'DISplay:WAVEView1:CURSor:CURSOR1:VBArs:APOSition {a_time:.13E}')
+            self.write(f'DISplay:WAVEView1:CURSor:CURSOR1:VBArs:BPOSition {b_time:.13E}')
         dv = self.query_value('DISplay:WAVEView1:CURSor:CURSOR1:HBArs:DELTa?')
 
         return dv / abs(self.di[step])
@@ -191,18 +502,46 @@ class Oscope:
         actual_b_time = self.actual_t_values[step + 1]
         a_time = actual_a_time - 1e-3
         b_time = actual_b_time - 1e-3
-        self.write(f'DISplay:WAVEView1:CURSor:CURSOR1:VBArs:APOSition {a_time:.13E}')
-        self.write(f'DISplay:WAVEView1:CURSor:CURSOR1:VBArs:BPOSition {b_time:.13E}')
+        with self.batch():
+            self.write(f'DISplay:WAVEView1:CURSor:CURSOR1:VBArs:APOSition {a_time:.13E}')
+            self.write(f'DISplay:WAVEView1:CURSor:CURSOR1:VBArs:BPOSition {b_time:.13E}')
         dv = self.query_value('DISplay:WAVEView1:CURSor:CURSOR1:HBArs:DELTa?')
 
         return dv / abs(self.di[step])
         
+    def fetch_waveform(self, channel:int):
+        with self.lock:     # nobody else can change the data source until we've read the waveform
+            record_length = int(self.ll_query('HORizontal:RECOrdlength?'))
+            with self.batch():
+                self.write(f'DATa:SOUrce CH{channel}')
+                self.write('DATa:ENCdg SRIBinary')      # signed integers, least significant byte first
+                self.write('WFMOutpre:BYT_Nr 2')
+                self.write('DATa:STARt 1')
+                self.write(f'DATa:STOP {record_length}')
+            fields = ['XINCR', 'XZERO', 'PT_OFF', 'YMULT', 'YOFF', 'YZERO']
+            reply = self.ll_query(join_commands([f'WFMOutpre:{field}?' for field in fields]))     # get the scaling for all of them in one go
+            preamble = {field: float(value) for field, value in zip(fields, reply.split(';'))}
+            debug(f'    reading CH{channel} waveform from scope ({record_length} points)')
+            with span('scope', 'CURVe?') as record:
+                raw = self.scope_res.query_binary_values('CURVe?', datatype='h', is_big_endian=False, container=np.array)
+                record['reply'] = f'{len(raw)} points'
+        return analysis.scale_waveform(raw, preamble)
+
+    def fetch_waveforms(self):
+        self.write('ACQuire:STATE STOP')    # make sure both channels come from the same acquisition
+        self.t, self.v = self.fetch_waveform(Settings['v_channel'])
+        _, i = self.fetch_waveform(Settings['i_channel'])
+        self.i = i * Settings['i_scale_factor']     # convert the current monitor voltage to amps
+        self.write('ACQuire:STATE RUN')
+
     def min(self):
         min = self.query_value('MEASUrement:MEAS:RESUlts:CURRentacq:MINimum?')
         return min
 
     def recall_setup(self, setup_name:str):
-        self.write(f'RECAll:SETUp "{setup_name}"')
+        self.write(f'RECAll:SETUp "{setup_name}"')      # this forgets everything in self.state
+        if Settings['check_scope_state']:   # find out what the setup file set everything to
+            self.state.update(parse_settings(self.get_current_settings()))
 
     def cd(self, dir:str):
         self.write(f'FILES:CWD "{dir}"')
@@ -211,10 +550,19 @@ class Oscope:
         self.write(f'FILES:MKDIR "{dir}"')
 
     def save_waveforms(self, filename:str):
-        self.write(f'SAVE:WAVEFORM CH{Settings["v_channel"]}, "{filename}_V.mat"')
-        self.write(f'SAVE:WAVEFORM CH{Settings["i_channel"]}, "{filename}_I.mat"')
+        with self.batch():
+            self.write(f'SAVE:WAVEFORM CH{Settings["v_channel"]}, "{filename}_V.mat"')
+            self.write(f'SAVE:WAVEFORM CH{Settings["i_channel"]}, "{filename}_I.mat"')
+        if Settings['archive_path'] is not None and Settings['local_analysis']:
+            archive_waveforms(int(filename), self.t, self.v, self.i, self.actual_t_values)
 
     def find_edges(self):
+        if Settings['local_analysis']:
+            self.fetch_waveforms()
+            self.di = list(analysis.current_steps(Settings)[0])
+            self.actual_t_values = analysis.find_edges(Settings, self.t, self.i)
+            return
+
         i_sequence = [0] + Settings['i_sequence'][0] + [0]
         t_values = [0]
         for i in range(len(Settings['i_sequence'][0])):
@@ -244,65 +592,164 @@ class Oscope:
                 self.write('SEARCH:SEARCH1:NAVigate NEXT')
                 
         # self.write('DISplay:WAVEView1:ZOOM:ZOOM1:STATe 0')        # this causes the lt res. measurement to be wrong. wtf?
-        self.actual_t_values.sort()
-        self.actual_t_values = list(set(self.actual_t_values))
+        self.actual_t_values = sorted(set(self.actual_t_values))      # remove duplicates, then sort (a set doesn't keep the order)
 
         self.write('ACQuire:STATE RUN')
 
 
-def calc_res():
-    st_res_list = []
-    lt_res_list = []
-    max_lt_res_dur = 0
-    for i in range(len(Settings['measure_res_at'])):
-        if Settings['measure_res_at'][i][1] == 'min':
-            if Settings['i_sequence'][1][Settings['measure_res_at'][i][0]] > max_lt_res_dur:
-                max_lt_res_dur = Settings['i_sequence'][1][Settings['measure_res_at'][i][0]]
-                lt_res_list = [scope.measure_resistance_over(Settings['measure_res_at'][i][0])]
-            else:
-                lt_res_list.append(scope.measure_resistance_over(Settings['measure_res_at'][i][0]))
-        else:
-            st_res_list.append(scope.measure_resistance_at(Settings['measure_res_at'][i][0], Settings['measure_res_at'][i][1]))
-        if i == len(Settings['measure_res_at']) - 1:
-            st_res = sum(st_res_list) / len(st_res_list)
-            lt_res = sum(lt_res_list) / len(lt_res_list)
-    return st_res, lt_res
+waveform_lot = None
+archive_lock = threading.Lock()
 
+def archive_waveforms(cell_num:int, t, v, i, edges):
+    # we already have the waveforms here with local_analysis, so they go straight into the archive without the .mat files
+    global waveform_lot
+    import archive      # only needed if there's an archive, and it imports goodLab
+    with archive_lock:
+        if waveform_lot is None:
+            waveform_lot = archive.Lot(os.path.join(Settings['archive_path'], Settings['group_name']), len(edges))
+    try:
+        waveform_lot.add(cell_num, t, v, i, edges)
+    except ValueError as e:
+        errors([f'{e}. The waveforms are still in the .mat files.'])
 
-#############################################################################################################
+def calc_res(scope:Oscope):
+    if Settings['local_analysis']:     # find_edges already got the waveforms
+        res_list = analysis.resistances(Settings, scope.t, scope.v, scope.actual_t_values)
+    else:
+        res_list = []
+        for step, freq in Settings['measure_res_at']:
+            if freq == 'min':
+                res_list.append(scope.measure_resistance_over(step))
+            else:
+                res_list.append(scope.measure_resistance_at(step, freq))
+    return analysis.combine_res(Settings, res_list)
 
+def open_probe(rm, resource_name:str):
+    # opens a resource with a short timeout so absent devices and serial ports don't hold us up
+    instr = rm.open_resource(resource_name, open_timeout=Settings['probe_timeout_ms'])
+    try:
+        normal_timeout = instr.timeout
+        instr.timeout = Settings['probe_timeout_ms']
+    except:
+        close_quietly(instr)
+        raise
+    return instr, normal_timeout
 
-rm = pyvisa.ResourceManager()
+def close_quietly(instr):
+    # for instruments we opened to look at but aren't going to use, so we don't leave VISA sessions open
+    try:
+        instr.close()
+    except:
+        pass
 
-visa_list = rm.list_resources()    # find all connected VISA instruments
-load_res = scope_res = {}
-for i in range(len(visa_list)):
+def probe(rm, resource_name:str):
+    # works out whether a resource is the load or the scope. returns (role, idn, instr) or None if it's neither
     try:
-        instr = rm.open_resource(visa_list[i])
+        instr, normal_timeout = open_probe(rm, resource_name)
+    except:
+        debug(f'{resource_name} is not a VISA instrument. Skipping...')      # any serial ports will show up even if they're not VISA instruments
+        return None
+    try:
+        idn = instr.query('*IDN?').strip()
+    except:
+        errors([f"Couldn't read ID from {resource_name}. ¯\_(ツ)_/¯"])
+        close_quietly(instr)
+        return None
+    try:
+        instr.query('source:current?')      # if it has a current setting, it's probably the load
+        role = 'load'
+    except:
         try:
-            if load_res == {}:
-                instr.query('source:current?')      # if it has a current setting, it's probably the load
-                i_source = instr.query('*IDN?')
-                debug(f'Found load: {i_source}', True)
-                load_res = instr
+            instr.query('*ESR?')    # the scope will have errors from the source command, this clears them
+            instr.query('ALLEV?')
         except:
-            try:
-                if scope_res == {}:
-                    instr.query('*ESR?')    # the scope will have errors from the previous source command, this clears them
-                    instr.query('ALLEV?')
-                    oscope_id = instr.query('*IDN?')        # if it's a VISA instrument and it's not the load, we'll assume it's the scope
-                    debug(f'Found oscilloscope: {oscope_id}', True)     # there should be a better way to do this but this'll work ¯\_(ツ)_/¯
-                    scope_res = instr
-            except:
-                errors([f"Couldn't read ID from {visa_list[i]}. ¯\_(ツ)_/¯"])
+            pass
+        role = 'scope'      # if it's a VISA instrument and it's not the load, we'll assume it's the scope
+    instr.timeout = normal_timeout
+    return role, idn, instr
+
+def check_cached(rm, cached:dict):
+    # opens the resource we found last time and makes sure it's still the same instrument
+    try:
+        instr, normal_timeout = open_probe(rm, cached['resource'])
     except:
-        debug(f'{visa_list[i]} is not a VISA instrument. Skipping...')      # any serial ports will show up even if they're not VISA instruments
-    
-scope = Oscope(scope_res)
-load = Load(load_res)
+        return None
+    try:
+        if instr.query('*IDN?').strip() == cached['idn']:
+            instr.timeout = normal_timeout
+            return instr
+    except:
+        pass
+    close_quietly(instr)
+    return None
+
+def find_instruments(rm, cache_path:str = 'instruments.json'):
+    found = {}
+    try:
+        with open(cache_path) as cache_file:
+            cache = json.load(cache_file)
+    except:
+        cache = {}
+
+    for role, cached in cache.items():      # try wherever they were last time first, that's almost always where they'll be
+        instr = check_cached(rm, cached)
+        if instr is not None:
+            found[role] = (cached['idn'], instr, cached['resource'])
+
+    if len(found) < 2:
+        visa_list = rm.list_resources()    # find all connected VISA instruments
+        known = [resource for _, _, resource in found.values()]
+        to_probe = [resource for resource in visa_list if resource not in known]
+        with ThreadPoolExecutor(max_workers=max(1, len(to_probe))) as pool:
+            results = list(pool.map(lambda resource: probe(rm, resource), to_probe))
+        for resource, result in zip(to_probe, results):     # if there's more than one of something, use the first one in the list
+            if result is not None and result[0] not in found:
+                role, idn, instr = result
+                found[role] = (idn, instr, resource)
+            elif result is not None:
+                close_quietly(result[2])
 
-try:
-    path = os.path.dirname(os.path.realpath(__file__))      # get the path this Python file is in
+    load_res = scope_res = {}
+    if 'load' in found:
+        debug(f'Found load: {found["load"][0]}', True)
+        load_res = found['load'][1]
+    if 'scope' in found:
+        debug(f'Found oscilloscope: {found["scope"][0]}', True)
+        scope_res = found['scope'][1]
+
+    try:
+        with open(cache_path, 'w') as cache_file:
+            json.dump({role: {'resource': resource, 'idn': idn} for role, (idn, _, resource) in found.items()}, cache_file, indent=4)
+    except Exception as err:
+        log(f"Couldn't save {cache_path}: {err}")
+    return load_res, scope_res
+
+def find_stations(rm):
+    # finds every load and scope and pairs them up. returns [(load_res, scope_res), ...]
+    visa_list = rm.list_resources()
+    with ThreadPoolExecutor(max_workers=max(1, len(visa_list))) as pool:
+        results = list(pool.map(lambda resource: probe(rm, resource), visa_list))
+    found = {'load': {}, 'scope': {}}
+    for resource, result in zip(visa_list, results):
+        if result is not None:
+            role, idn, instr = result
+            found[role][resource] = instr
+            debug(f'Found {role}: {idn} at {resource}', True)
+
+    if len(Settings['station_pairs']) > 0:
+        pairs = [(found['load'][load], found['scope'][scope]) for load, scope in Settings['station_pairs']]
+    else:
+        pairs = list(zip(found['load'].values(), found['scope'].values()))
+    if Settings['stations'] > 0:
+        pairs = pairs[:Settings['stations']]
+    used = set(id(instr) for pair in pairs for instr in pair)
+    for instrs in found.values():
+        for instr in instrs.values():
+            if id(instr) not in used:
+                close_quietly(instr)
+    return pairs
+
+def setup_scope(scope:Oscope, path:str):
     scope.cd(path)
     scope.recall_setup('scope_setup.set')
     scope.write('HORizontal:MODE MANual')    # manual mode allows us to set the acquisition time precisely
@@ -314,98 +761,363 @@ try:
         scope.mkdir(f"{Settings['group_name']}")
     scope.cd(os.path.join(path, Settings['group_name']))
 
-    cell_data = []
-    cell_data_path = f"{Settings['group_name']}.csv"
+    trig_level = Settings['i_sequence'][0][0] / (2 * Settings['i_scale_factor'])
+    scope.write(f'TRIGger:A:LEVel:CH{Settings["i_channel"]} {trig_level:.13E}')
+
+def read_csv_header(cell_data_path:str):
+    header = ['num','v0', 'res_st', 'res_lt']
     if not os.path.exists(cell_data_path):     # make a CSV file for the data if it doesn't already exist
         with open(cell_data_path, 'w') as csvfile:
             csvfile.write('num,v0,res_st,res_lt\n')
-            header = ['num','v0', 'res_st', 'res_lt']
         subprocess.run(f'svn add {cell_data_path}')
     else:
         with open(cell_data_path, 'r') as csvfile:
-            reader = csv.reader(csvfile)
-            header = next(reader)
-            for row in reader:
-                cell = {header[i]: float(value_str) for i, value_str in enumerate(row)}
-                cell_data.append(cell)
+            header = next(csv.reader(csvfile))
+    return header
+
+def load_cell_data(cell_data_path:str):
+    cell_data = []
+    header = read_csv_header(cell_data_path)
+    with open(cell_data_path, 'r') as csvfile:
+        reader = csv.reader(csvfile)
+        next(reader)
+        for row in reader:
+            cell = {header[i]: float(value_str) for i, value_str in enumerate(row)}
+            cell_data.append(cell)
+    if len(cell_data) > 0:
         debug(f'Loaded previous test data for {len(cell_data)} cells.', True)
+    return cell_data, header
 
-    trig_level = Settings['i_sequence'][0][0] / (2 * Settings['i_scale_factor'])
-    scope.write(f'TRIGger:A:LEVel:CH{Settings["i_channel"]} {trig_level:.13E}')
+def open_results(cell_data_path:str):
+    # returns what we rank new cells against (a ResultStore, or a Ranking of everything in the CSV file),
+    # the CSV header and the number of the last cell tested
+    if not Settings['use_result_db']:
+        cell_data, header = load_cell_data(cell_data_path)
+        return Ranking(cell_data), header, int(cell_data[-1]['num']) if cell_data else None
 
-#########################################################################################################################
+    db_path = os.path.splitext(cell_data_path)[0] + '.db'
+    new_db = not os.path.exists(db_path)
+    store = ResultStore(db_path)
+    header = read_csv_header(cell_data_path)
+    if new_db and store.count == 0:     # first time with the database, bring in what's already been tested
+        store.import_csv(cell_data_path)
+    if store.count > 0:
+        debug(f'Loaded previous test data for {store.count} cells.', True)
+    return store, header, store.last_num()
 
-    while True:
-        try:
-            cell_num = int(cell_data[-1]['num'] + 1)
-        except:
-            cell_num = 1
-        inp = input(f'Enter cell number or just hit enter to test cell {cell_num}  ')
-        if inp != '':
+@contextmanager
+def no_phase(name:str):
+    yield
+
+def test_cell(load:Load, scope:Oscope, cell_num:int, v0:float, expected_min_v:float, phase = no_phase):
+    # phase(name) is a context manager around each part of the test, runner.py uses it to time them
+    with phase('setup'):
+        scope.set_v_range(Settings['v_channel'], expected_min_v - 0.2, v0 + 0.1)
+        if not scope.wait_until_ready():    # changing the voltage range makes the scope untriggerable for a second
+            errors(['Oscilloscope is not ready to trigger.'], 'scope')
+    with phase('trigger'):
+        times = scope.times_triggered()
+        load.trigger()
+        triggered = scope.wait_for_acquisition(times)
+    if not triggered:
+        errors(['Oscilloscope was not triggered.'], 'scope')
+        return None
+
+    with phase('analysis'):
+        dip_v = scope.min()
+        if dip_v < Settings['v_min']:
+            debug(f'OMG! Cell voltage dipped to {dip_v:.2f} which is below minimum!', True)
+
+        scope.find_edges()
+        res_st, res_lt = calc_res(scope)
+    return res_st, res_lt
+
+class Ranking:
+    # keeps each resistance in a sorted list and a running mean and variance (Welford's method), so finding where a
+    # cell ranks is a binary search, O(log n), and adding one is a single insort instead of re-sorting every cell
+    # we've ever tested
+    keys = ['res_st', 'res_lt']
+
+    def __init__(self, cell_data:list = ()):
+        self.sorted = {key: sorted(cell[key] for cell in cell_data) for key in self.keys}
+        self.count = 0
+        self.means = {key: 0.0 for key in self.keys}
+        self.m2 = {key: 0.0 for key in self.keys}     # sum of squared differences from the mean
+        self.history = {}   # earlier results for each cell number
+        for cell in cell_data:
+            self.update_stats(cell)
+            self.history.setdefault(int(cell['num']), []).append(cell)
+
+    def add(self, cell:dict):
+        # returns the earlier results for the same cell number, like ResultStore.add() does
+        for key in self.keys:
+            insort(self.sorted[key], cell[key])
+        self.update_stats(cell)
+        previous = self.history.setdefault(int(cell['num']), [])
+        earlier = list(previous)
+        previous.append(cell)
+        return earlier
+
+    def update_stats(self, cell:dict):
+        self.count += 1
+        for key in self.keys:
+            delta = cell[key] - self.means[key]
+            self.means[key] += delta / self.count
+            self.m2[key] += delta * (cell[key] - self.means[key])
+
+    def mean(self, key:str, default:float = None):
+        return self.means[key] if self.count > 0 else default
+
+    def std(self, key:str):
+        return math.sqrt(self.m2[key] / self.count) if self.count > 0 else 0.0
+
+    def rank(self, key:str, value:float):
+        # 1 is the highest resistance. a cell ranks below any others with the same value, since they were tested first
+        return self.count - bisect_left(self.sorted[key], value)
+
+    def percentile(self, key:str, value:float):
+        return (self.count - self.rank(key, value)) / max(1, (self.count - 1)) * 100
+
+csv_lock = threading.Lock()     # every station appends to the same CSV file
+
+def record_result(cell:dict, ranks:dict, header:list, cell_data_path:str):
+    # appends the cell we just tested to the CSV file and shows how it ranks against the ones before it
+    with csv_lock, open(cell_data_path, 'a', newline = '') as csvfile:
+        writer = csv.writer(csvfile)
+        csvRow = []
+        for i in range(len(header)):
+            if header[i] == 'num':
+                csvRow.append(f"{cell['num']:03d}")
+            else:
+                csvRow.append(f'{cell[header[i]]}')
+        writer.writerow(csvRow)
+    cells_tested = ranks['count']
+    print(f'              2 kHz             {Settings["i_sequence"][1][0]} sec')
+    print(f'Resistance: {(cell["res_st"] * 1000):.3f}e-3         {(cell["res_lt"] * 1000):.3f}e-3')
+    print(f'Rank:        {ranks["res_st"]} of {cells_tested}            {ranks["res_lt"]} of {cells_tested}')
+    print(f'Percentile:   {ranks["res_st_pct"]:.0f}%               {ranks["res_lt_pct"]:.0f}%\n')
+
+def record_spectrum(scope:Oscope, cell_num:int, spectrum_path:str):
+    # the impedance spectrum from the waveforms local_analysis already fetched, so it doesn't add anything to the test
+    freqs, z = analysis.impedance_spectrum(Settings, scope.t, scope.v, scope.i)
+    features = analysis.spectrum_features(freqs, z)
+    with csv_lock:
+        new_file = not os.path.exists(spectrum_path)
+        with open(spectrum_path, 'a', newline = '') as csvfile:
+            writer = csv.writer(csvfile)
+            if new_file:
+                writer.writerow(['num'] + list(features))
+            writer.writerow([f'{cell_num:03d}'] + [f'{value}' for value in features.values()])
+    debug(f'Impedance {features["r_hf"] * 1000:.3f}e-3 at high frequency, {features["r_lf"] * 1000:.3f}e-3 at low frequency')
+
+def rank_cell(ranking, cell:dict):
+    # ranking is a Ranking or a ResultStore
+    previous = ranking.add(cell)
+    if len(previous) > 0:
+        when = previous[-1].get('tested_at', '')
+        errors([f'Cell {cell["num"]} has already been tested {len(previous)} time(s){" (last on " + when + ")" if when else ""}. '
+                'Both results are saved, decide which one is valid and remove the others before running cellect.py.'])
+    ranks = {'count': ranking.count}
+    for key in Ranking.keys:
+        ranks[key] = ranking.rank(key, cell[key])
+        ranks[f'{key}_pct'] = ranking.percentile(key, cell[key])
+    return ranks
+
+class ResultWorker:
+    # saves the waveforms and results for each cell on a background thread, in the order the cells were tested,
+    # so the operator can swap in the next cell and enter its number while that's happening
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.scope_free = threading.Event()     # cleared until the waveforms are saved, the next trigger would overwrite them
+        self.scope_free.set()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, scope:Oscope, cell_num:int, *record_args):
+        self.scope_free.clear()
+        self.jobs.put((scope, cell_num, record_args))
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            scope, cell_num, record_args = job
             try:
-                cell_num = int(inp)
-            except:
-                errors([f'"{inp}" is not a valid number.'])
-                continue
-        
+                scope.save_waveforms(str(cell_num))
+            except Exception as err:
+                errors([f"Couldn't save waveforms for cell {cell_num}: {err}"], 'scope')
+            finally:
+                self.scope_free.set()
+            try:
+                record_result(*record_args)
+            except Exception as err:
+                errors([f"Couldn't save results for cell {cell_num}: {err}"])
+
+    def close(self):
+        # finish everything that's been submitted, then stop the thread
+        self.jobs.put(None)
+        self.thread.join()
+
+
+#############################################################################################################
+
+
+class Session:
+    # the results and the console, shared between all the stations
+    def __init__(self, cell_data_path:str, num_stations:int):
+        self.cell_data_path = cell_data_path
+        self.ranking, self.header, self.last_num = open_results(cell_data_path)
+        self.num_stations = num_stations
+        self.lock = threading.Lock()    # one station at a time updates the results
+        self.console = threading.Lock()     # one station at a time asks the operator something
+        self.testing = set()    # cell numbers a station is testing right now
+
+    def prompt(self, station:int, text:str):
+        with self.console:
+            return self.ask(station, text)
+
+    def ask(self, station:int, text:str):
+        if self.num_stations > 1:
+            text = f'Station {station}: {text}'
+        return input(text)
+
+    def next_cell_num(self, station:int):
+        # offers the number after the last cell any station started, skipping the ones still being tested. holding the
+        # console until the number is claimed means two stations are never offered the same cell
+        with self.console:
+            with self.lock:
+                cell_num = 1 if self.last_num is None else self.last_num + 1
+                while cell_num in self.testing:
+                    cell_num += 1
+            inp = self.ask(station, f'Enter cell number or just hit enter to test cell {cell_num}  ')
+            if inp != '':
+                try:
+                    cell_num = int(inp)
+                except:
+                    errors([f'"{inp}" is not a valid number.'])
+                    return None, None
+            with self.lock:
+                self.testing.add(cell_num)
+                self.last_num, previous = cell_num, self.last_num
+            return cell_num, previous
+
+    def failed(self, cell_num:int, previous:int):
+        # offer the same number again, unless another station has moved on since
+        with self.lock:
+            self.testing.discard(cell_num)
+            if self.last_num == cell_num:
+                self.last_num = previous
+
+    def add_result(self, cell:dict):
+        with self.lock:
+            self.testing.discard(cell['num'])
+            return rank_cell(self.ranking, cell)
+
+def save_cell(session:Session, scope:Oscope, worker:ResultWorker, cell:dict):
+    # saves the waveforms of a cell that's just been tested, then ranks it and saves its results. anything that raises
+    # does it before the cell is ranked, so it can be tested again without being counted twice. once it's ranked, a
+    # problem writing the spectrum or the CSV is reported instead, the same as ResultWorker does
+    if worker is None:
+        scope.save_waveforms(str(cell['num']))
+    ranks = session.add_result(cell)
+    try:
+        if Settings['spectrum'] and Settings['local_analysis']:
+            record_spectrum(scope, cell['num'], os.path.splitext(session.cell_data_path)[0] + '_spectrum.csv')
+    except Exception as err:
+        errors([f"Couldn't save the spectrum for cell {cell['num']}: {err}"])
+    if worker is not None:
+        worker.submit(scope, cell['num'], cell, ranks, session.header, session.cell_data_path)
+    else:
         try:
-            all_lt_res = [cell['res_lt'] for cell in cell_data]
-            mean_lt_res = sum(all_lt_res) / len(all_lt_res)
-        except:
-            mean_lt_res = Settings['default_res']
-        v0 = load.v()
-        expected_min_v = v0 - max(Settings['i_sequence'][0]) * mean_lt_res
-        inp = {}
-        if expected_min_v < Settings['v_min']:
-            while inp != 'Y' and inp != 'y' and inp != 'N' and inp != 'n':
-                inp = input(f'Cell voltage is only {v0:.2f}. It may drop below the minimum of {Settings["v_min"]:.2f}. Continue? [Y/N]')
-        if inp == 'Y' or inp == 'y' or inp == {}:
-            scope.set_v_range(Settings['v_channel'], expected_min_v - 0.2, v0 + 0.1)
-            sleep(2)    # changing the voltage range makes the scope untriggerable for a second
-            times = scope.times_triggered()
-            load.trigger()
-            if not scope.times_triggered() > times:
-                errors(['Oscilloscope was not triggered.'], 'scope')
+            record_result(cell, ranks, session.header, session.cell_data_path)
+        except Exception as err:
+            errors([f"Couldn't save results for cell {cell['num']}: {err}"])
+
+def run_station(session:Session, station:int, load:Load, scope:Oscope):
+    worker = ResultWorker() if Settings['pipelined'] else None
+    try:
+        while True:
+            cell_num, previous = session.next_cell_num(station)
+            if cell_num is None:
+                continue
+
+            mean_lt_res = session.ranking.mean('res_lt', Settings['default_res'])
+            v0 = load.v()
+            expected_min_v = v0 - max(Settings['i_sequence'][0]) * mean_lt_res
+            inp = {}
+            if expected_min_v < Settings['v_min']:
+                while inp != 'Y' and inp != 'y' and inp != 'N' and inp != 'n':
+                    inp = session.prompt(station, f'Cell voltage is only {v0:.2f}. It may drop below the minimum of {Settings["v_min"]:.2f}. Continue? [Y/N]')
+            if inp == 'Y' or inp == 'y' or inp == {}:
+                if worker is not None:
+                    worker.scope_free.wait()    # the last cell's waveforms have to be saved before we trigger again
+                result = test_cell(load, scope, cell_num, v0, expected_min_v)
+                if result is None:
+                    session.failed(cell_num, previous)
+                else:
+                    res_st, res_lt = result
+                    save_cell(session, scope, worker, {"num": cell_num, "v0": v0, "res_st": res_st, "res_lt": res_lt})
             else:
-                dip_v = scope.min()
-                if dip_v < Settings['v_min']:
-                    debug(f'OMG! Cell voltage dipped to {dip_v:.2f} which is below minimum!', True)
+                session.failed(cell_num, previous)
+    finally:
+        load.write('INP 0')
+        if worker is not None:
+            worker.close()
 
-                scope.find_edges()
-                res_st, res_lt = calc_res()
+def run_station_thread(session:Session, station:int, load:Load, scope:Oscope):
+    # with more than one station, a problem with one of them shouldn't stop the others
+    try:
+        run_station(session, station, load, scope)
+    except Exception as err:
+        log(f"station {station}: {err}: {type(err)}\r\n")
+        errors([f'Station {station} stopped: {err}'])
 
-                scope.save_waveforms(str(cell_num))
 
-                cell_data.append({"num": cell_num, "v0": v0, "res_st": res_st, "res_lt": res_lt})
-                with open(cell_data_path, 'a', newline = '') as csvfile:
-                    writer = csv.writer(csvfile)
-                    csvRow = []
-                    for i in range(len(header)):
-                        if header[i] == 'num':
-                            csvRow.append(f"{cell_data[-1]['num']:03d}")
-                        else:
-                            csvRow.append(f'{cell_data[-1][header[i]]}')
-                    writer.writerow(csvRow)
-                cells_tested = len(cell_data)
-                cell_data_sorted_st = sorted(cell_data, key=lambda k: k['res_st'], reverse = True)
-                cell_data_sorted_lt = sorted(cell_data, key=lambda k: k['res_lt'], reverse = True)
-                # find the rank of the current cell
-                rank_st = rank_lt = 0
-                for i in range(cells_tested):
-                    if cell_data_sorted_st[i]['num'] == cell_num:
-                        rank_st = i + 1
-                    if cell_data_sorted_lt[i]['num'] == cell_num:
-                        rank_lt = i + 1
-                print(f'              2 kHz             {Settings["i_sequence"][1][0]} sec')
-                print(f'Resistance: {(res_st * 1000):.3f}e-3         {(res_lt * 1000):.3f}e-3')
-                print(f'Rank:        {rank_st} of {cells_tested}            {rank_lt} of {cells_tested}')
-                print(f'Percentile:   {((cells_tested - rank_st) / max(1, (cells_tested - 1)) * 100):.0f}%               {(cells_tested - rank_lt) / max(1, (cells_tested - 1)) * 100:.0f}%\n')
-
-except Exception as err:
-    log(f"{err}: {type(err)}\r\n")
-    input('Something went wrong I guess. ¯\_(ツ)_/¯\n\r Hit enter to quit, then you can try restarting GoodLab.')
-
-finally:
-    load.write('INP 0')
+#############################################################################################################
+
+
+def commit_results(cell_data_path:str):
     subprocess.run(f'svn commit -m "Updated battery test data" {cell_data_path}', shell=True)
-    # scope.restore_settings()
+
+def main():
+    rm = pyvisa.ResourceManager()
+    if Settings['stations'] == 1:
+        stations = [find_instruments(rm)]
+    else:
+        stations = find_stations(rm)
+        debug(f'Testing on {len(stations)} stations.', True)
+
+    scopes = [Oscope(scope_res) for _, scope_res in stations]
+    loads = [Load(load_res) for load_res, _ in stations]
+
+    cell_data_path = f"{Settings['group_name']}.csv"
+    try:
+        path = os.path.dirname(os.path.realpath(__file__))      # get the path this Python file is in
+        for scope in scopes:
+            setup_scope(scope, path)
+        session = Session(cell_data_path, len(stations))
+
+#########################################################################################################################
+
+        if len(stations) == 1:
+            run_station(session, 1, loads[0], scopes[0])
+        else:
+            threads = [threading.Thread(target=run_station_thread, args=(session, i + 1, loads[i], scopes[i]), daemon=True) for i in range(len(stations))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+    except Exception as err:
+        log(f"{err}: {type(err)}\r\n")
+        input('Something went wrong I guess. ¯\_(ツ)_/¯\n\r Hit enter to quit, then you can try restarting GoodLab.')
+
+    finally:
+        for load in loads:
+            load.write('INP 0')
+        commit_results(cell_data_path)
+        # scope.restore_settings()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+import argparse
+import json
+import numpy as np
+import cellect
+from goodLab import Settings
+
+# predicts how the cells in each module share the current, since the cells of a module are in parallel and the ones
+# with less resistance or more voltage take more than their share. each cell is the same model as sim_visa.SimCell:
+# its open circuit voltage v0, the short term resistance st, and an RC pair of resistance lt for the slower part.
+# every module is simulated at once as one (modules x cells) array, so scoring a whole lot takes milliseconds and can
+# go inside a loop that tries different assignments. the cells' v0 is taken as constant over the profile.
+#   python packsim.py                                   sort G7_2023.csv with cellect and simulate the modules
+#   python packsim.py --module-list module_list.txt     simulate the modules that were actually written out
+#   python packsim.py --profile '[[1, 10, 0], [2, 20, 10]]' --worst 10
+
+TAU_S = 4.0     # time constant of the RC pair, the same as sim_visa.SimCell
+DT_S = 0.1      # longest time step of the simulation
+
+def module_arrays(cells_sorted):
+    # the cells in modules as (modules x cells per module) arrays, padded where a module is short. pad is True for the
+    # padding. cells in module 0 are left out
+    cells = cellect.take(cells_sorted, cells_sorted['mod'] != 0)
+    cells = cellect.take(cells, np.lexsort((cells['num'], cells['mod'])))
+    starts = np.flatnonzero(np.diff(cells['mod'], prepend=-1))
+    sizes = np.diff(np.append(starts, len(cells)))
+    row = np.repeat(np.arange(len(starts)), sizes)
+    column = np.arange(len(cells)) - np.repeat(starts, sizes)
+    shape = (len(starts), sizes.max() if len(starts) > 0 else 0)
+    arrays = {'mods': cells['mod'][starts], 'sizes': sizes}
+    for key, fill in [('num', -1), ('v0', 0.0), ('st', np.inf), ('lt', 0.0)]:
+        arrays[key] = np.full(shape, fill, dtype=cells[key].dtype)
+        arrays[key][row, column] = cells[key]
+    arrays['pad'] = arrays['num'] == -1
+    return arrays
+
+def time_steps(profile, dt=DT_S):
+    # profile is [[i0, i1, ...], [t0, t1, ...]] like Settings['i_sequence'], in amps per cell and seconds.
+    # returns the current per cell and the length of every time step
+    currents, widths = [], []
+    for i, width in zip(*profile):
+        n = max(1, int(np.ceil(width / dt)))
+        currents += [i] * n
+        widths += [width / n] * n
+    return np.array(currents, dtype=float), np.array(widths, dtype=float)
+
+def simulate(cells_sorted, profile=None, tau=TAU_S, dt=DT_S, history=False):
+    # draws the profile from every module, scaled by how many cells it has, and solves for each cell's current at
+    # every step. the RC voltage is stepped exactly for a current held over the step, so each step is a linear
+    # system per module, all cells on one terminal voltage and the currents adding up to the module's. that system
+    # solves in closed form: the terminal voltage is a conductance weighted mean of the cells' internal voltages.
+    # returns one row per module, and the voltages and cell currents at every step if history is True
+    arrays = module_arrays(cells_sorted)
+    profile = Settings['i_sequence'] if profile is None else profile
+    currents, widths = time_steps(profile, dt)
+    pad = arrays['pad']
+    v0, st, lt = arrays['v0'], arrays['st'], arrays['lt']
+    module_i = currents[:, None] * arrays['sizes'][None, :]
+
+    u = np.zeros(v0.shape)      # the voltage across each cell's RC pair
+    peak_share = np.ones(len(arrays['mods']))
+    peak_i = np.zeros(len(arrays['mods']))
+    current_spread = np.zeros(len(arrays['mods']))
+    v_min = np.full(len(arrays['mods']), np.inf)
+    v_history, i_history = [], []
+    for step, width in enumerate(widths.tolist()):
+        decay = np.exp(-width / tau)
+        g = np.where(pad, 0.0, 1 / (st + lt * (1 - decay)))     # padding conducts nothing
+        e = v0 - decay * u
+        v = ((g * e).sum(axis=1) - module_i[step]) / g.sum(axis=1)
+        i = (e - v[:, None]) * g
+        u = decay * u + lt * (1 - decay) * i
+
+        np.minimum(v_min, v, out=v_min)
+        high = np.where(pad, -np.inf, i).max(axis=1)
+        low = np.where(pad, np.inf, i).min(axis=1)
+        np.maximum(peak_i, high, out=peak_i)
+        np.maximum(current_spread, high - low, out=current_spread)
+        if currents[step] > 0:
+            np.maximum(peak_share, high / currents[step], out=peak_share)
+        if history:
+            v_history.append(v)
+            i_history.append(i)
+
+    # what flows round each module at rest once the RC pairs have settled, from the cells' v0 alone
+    g_dc = np.where(pad, 0.0, 1 / (st + lt))
+    v_rest = (g_dc * v0).sum(axis=1) / g_dc.sum(axis=1)
+    rest_i = np.abs((v0 - v_rest[:, None]) * g_dc).max(axis=1)
+
+    result = np.zeros(len(arrays['mods']), dtype=[('mod', 'i8'), ('cells', 'i8'), ('peak_share', 'f8'), ('peak_i', 'f8'),
+                                                  ('current_spread', 'f8'), ('v_min', 'f8'), ('rest_i', 'f8')])
+    result['mod'] = arrays['mods']
+    result['cells'] = arrays['sizes']
+    result['peak_share'] = peak_share       # the most any cell carries compared with an even split
+    result['peak_i'] = peak_i
+    result['current_spread'] = current_spread   # the biggest difference between two cells' currents in the module
+    result['v_min'] = v_min
+    result['rest_i'] = rest_i
+    if not history:
+        return result
+    t = np.cumsum(widths)
+    return result, {'t': t, 'v': np.array(v_history).T, 'i': np.moveaxis(np.array(i_history), 0, -1), 'num': arrays['num']}
+
+def score(result):
+    # one number to compare assignments by, lower is better: how far over an even share the worst cell of the worst
+    # module gets, with the average over all modules to break ties
+    if len(result) == 0:
+        return 0.0
+    return float(result['peak_share'].max() - 1 + (result['peak_share'].mean() - 1) / 1000)
+
+def read_module_list(filename, cells):
+    # puts the module numbers from a module_list.txt written by cellect.py or cellstream.py onto the cells
+    mods = {}
+    with open(filename, 'r') as file:
+        for line in file:
+            if line.startswith('Module '):
+                name, nums = line.split(':', 1)
+                for num in nums.split(','):
+                    if num.strip() != '':
+                        mods[int(num)] = int(name.split()[1])
+    cells_sorted = np.zeros(len(cells), dtype=cellect.SORTED_DTYPE)
+    for name in ['num', 'v0', 'st', 'lt']:
+        cells_sorted[name] = cells[name]
+    cells_sorted['mod'] = [mods.get(num, 0) for num in cells['num'].tolist()]
+    missing = set(mods) - set(cells['num'].tolist())
+    if len(missing) > 0:
+        print(f'{len(missing)} cells in {filename} have no results, they are left out:', ', '.join(str(num) for num in sorted(missing)))
+    return cells_sorted
+
+def print_result(result, worst=None):
+    print(f'{"module":>7}{"cells":>7}{"peak share":>12}{"peak (A)":>10}{"spread (A)":>12}{"v min":>8}{"rest (A)":>10}')
+    order = np.argsort(-result['peak_share'], kind='stable')
+    for row in result[order[:worst]]:
+        print(f'{row["mod"]:>7}{row["cells"]:>7}{row["peak_share"]:>12.3f}{row["peak_i"]:>10.2f}{row["current_spread"]:>12.3f}'
+              f'{row["v_min"]:>8.3f}{row["rest_i"]:>10.3f}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate how the parallel cells in each module share the current.')
+    parser.add_argument('csv', nargs='?', default=cellect.CELL_DATA_PATH, help='the CSV goodLab.py writes results to')
+    parser.add_argument('--module-list', help='the module_list.txt to simulate, otherwise the cells are sorted with cellect first')
+    parser.add_argument('--profile', help='[[i0, i1, ...], [t0, t1, ...]] in amps per cell and seconds, defaults to i_sequence')
+    parser.add_argument('--worst', type=int, default=10, help='how many of the worst modules to list')
+    args = parser.parse_args()
+
+    cells = cellect.read_cells(args.csv)
+    if args.module_list is not None:
+        cells_sorted = read_module_list(args.module_list, cells)
+    else:
+        cells_sorted, total_modules = cellect.sort_cells(cells, plot=False, verbose=False)
+    profile = None if args.profile is None else json.loads(args.profile)
+    result = simulate(cells_sorted, profile)
+    print_result(result, args.worst)
+    print(f'{len(result)} modules, worst peak share {result["peak_share"].max():.3f}, mean {result["peak_share"].mean():.3f}, score {score(result):.4f}')
@@ -0,0 +1,154 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+import re
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+import analysis
+from goodLab import Settings
+
+# works out res_st and res_lt again from the <num>_V.mat and <num>_I.mat files Oscope.save_waveforms keeps for every
+# cell, with whatever settings you give it, so changing measure_res_at or slew_rate doesn't mean testing the lot again.
+# the cells are shared out over a process pool, and results are cached in reanalyze.db in the waveform folder by the
+# hash of the two files and of the settings that affect the answer, so running it again only analyzes what's changed.
+#   python reanalyze.py G7_2023 G7_2023_2khz.csv
+#   python reanalyze.py G7_2023 G7_2023_1khz.csv --set measure_res_at='[[1, 1000], [2, 1000], [1, "min"]]'
+#   python reanalyze.py G7_2023 out.csv --settings variant.json --results G7_2023.csv     keep the tested v0 for each cell
+
+ANALYSIS_KEYS = ['i_sequence', 'measure_res_at', 'slew_rate', 'i_scale_factor']     # the settings the results depend on
+
+def settings_hash(settings:dict):
+    used = {key: settings[key] for key in ANALYSIS_KEYS}
+    return hashlib.sha1(json.dumps(used, sort_keys=True).encode()).hexdigest()
+
+def file_hash(*paths:str):
+    sha = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+def find_waveforms(folder:str):
+    # {num: (V file, I file)} for every cell with both files
+    names = set(os.listdir(folder))
+    cells = {}
+    for name in names:
+        match = re.fullmatch(r'(\d+)_V\.mat', name, re.IGNORECASE)
+        if match is not None:
+            i_name = next((n for n in [f'{match[1]}_I.mat', f'{match[1]}_i.mat'] if n in names), None)
+            if i_name is not None:
+                cells[int(match[1])] = (os.path.join(folder, name), os.path.join(folder, i_name))
+    return dict(sorted(cells.items()))
+
+def analyze_cell(job:tuple):
+    # runs in a worker process. the same steps as Oscope.find_edges and calc_res with local_analysis on
+    num, v_path, i_path, settings = job
+    try:
+        t, v = analysis.load_mat(v_path)
+        t_i, i = analysis.load_mat(i_path)
+        edges = analysis.find_edges(settings, t_i, i * settings['i_scale_factor'])
+        res_st, res_lt = analysis.combine_res(settings, analysis.resistances(settings, t, v, edges))
+        before = v[t < edges[0]]
+        v0 = float(np.median(before)) if len(before) > 0 else float(v[0])    # the cell voltage before the load turned on
+        return num, (v0, res_st, res_lt), None
+    except Exception as e:
+        return num, None, f'{type(e).__name__}: {e}'
+
+class Cache:
+    def __init__(self, db_path:str):
+        self.db = sqlite3.connect(db_path)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS results (files TEXT, settings TEXT, v0 REAL, res_st REAL, res_lt REAL, PRIMARY KEY (files, settings))')
+
+    def get(self, files:str, settings:str):
+        return self.db.execute('SELECT v0, res_st, res_lt FROM results WHERE files = ? AND settings = ?', (files, settings)).fetchone()
+
+    def put(self, files:str, settings:str, result:tuple):
+        self.db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)', (files, settings, *result))
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+def tested_v0(results_path:str):
+    # the v0 the load measured when each cell was tested, the last one if it was tested more than once
+    with open(results_path, 'r') as csvfile:
+        return {int(row['num']): float(row['v0']) for row in csv.DictReader(csvfile)}
+
+def reanalyze(folder:str, settings:dict, workers:int = None, v0:dict = None):
+    # returns {num: (v0, res_st, res_lt)} and {num: error}
+    waveforms = find_waveforms(folder)
+    key = settings_hash(settings)
+    with ThreadPoolExecutor(max_workers=8) as pool:     # hashing is mostly waiting on the disk
+        hashes = dict(zip(waveforms, pool.map(lambda files: file_hash(*files), waveforms.values())))
+
+    cache = Cache(os.path.join(folder, 'reanalyze.db'))
+    results = {}
+    jobs = []
+    for num, (v_path, i_path) in waveforms.items():
+        cached = cache.get(hashes[num], key)
+        if cached is not None:
+            results[num] = tuple(cached)
+        else:
+            jobs.append((num, v_path, i_path, settings))
+    print(f'{len(waveforms)} cells, {len(results)} already analyzed with these settings, {len(jobs)} to do')
+
+    failed = {}
+    if len(jobs) > 0:
+        with ProcessPoolExecutor(max_workers=workers) as pool, cache.db:
+            chunksize = max(1, len(jobs) // (4 * (workers or os.cpu_count() or 1)))
+            for done, (num, result, error) in enumerate(pool.map(analyze_cell, jobs, chunksize=chunksize), 1):
+                if error is not None:
+                    failed[num] = error
+                else:
+                    results[num] = result
+                    cache.put(hashes[num], key, result)
+                if done % 100 == 0:
+                    print(f'{done} of {len(jobs)}')
+    cache.close()
+
+    if v0 is not None:
+        results = {num: (v0.get(num, result[0]), result[1], result[2]) for num, result in results.items()}
+    return dict(sorted(results.items())), failed
+
+def write_results(results:dict, csv_path:str):
+    # the same format goodLab.py writes, so cellect.py can read it
+    with open(csv_path, 'w', newline = '') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['num', 'v0', 'res_st', 'res_lt'])
+        for num, (v0, res_st, res_lt) in results.items():
+            writer.writerow([f'{num:03d}', f'{v0}', f'{res_st}', f'{res_lt}'])
+
+def parse_overrides(settings_path:str, overrides:list):
+    settings = dict(Settings)
+    if settings_path is not None:
+        with open(settings_path, 'r') as file:
+            settings.update(json.load(file))
+    for override in overrides:
+        name, value = override.split('=', 1)
+        if name not in settings:
+            raise KeyError(f'{name} is not in goodLab.Settings')
+        settings[name] = json.loads(value)
+    return settings
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Recalculate cell resistances from saved waveforms with different settings.')
+    parser.add_argument('folder', help='folder with the <num>_V.mat and <num>_I.mat files')
+    parser.add_argument('output', help='results CSV to write')
+    parser.add_argument('--settings', help='JSON file of goodLab.Settings values to change')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=JSON', help='change one setting, can be given more than once')
+    parser.add_argument('--results', help='the CSV from testing, to keep the v0 the load measured instead of the one from the waveform')
+    parser.add_argument('--workers', type=int, help='number of processes, defaults to one per CPU')
+    args = parser.parse_args()
+
+    settings = parse_overrides(args.settings, args.set)
+    v0 = tested_v0(args.results) if args.results is not None else None
+    results, failed = reanalyze(args.folder, settings, args.workers, v0)
+    write_results(results, args.output)
+    for num, error in failed.items():
+        print(f'Cell {num}: {error}')
+    print(f'Wrote {len(results)} cells to {args.output}, {len(failed)} failed')
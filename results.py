@@ -0,0 +1,112 @@
+import sqlite3
+import threading
+import csv
+import os
+import sys
+from bisect import bisect_left, insort
+from datetime import datetime
+
+# every test result goes into a SQLite database with the full history for each cell number. the running mean and
+# variance are kept in the database too, so opening it doesn't mean reading every result, however big the lot is.
+# it ranks a new cell the same way goodLab.Ranking does, with a binary search of sorted lists that are read from the
+# resistance indexes the first time a cell is ranked, and export_csv() writes the num,v0,res_st,res_lt file cellect.py reads.
+
+KEYS = ['res_st', 'res_lt']
+
+class ResultStore:
+    def __init__(self, db_path:str):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_path, check_same_thread=False)     # every station shares it, the lock keeps them in turn
+        self.db.execute('PRAGMA journal_mode=WAL')      # appends don't rewrite the file, and readers don't block the writer
+        self.db.execute('PRAGMA synchronous=FULL')      # a result is on disk before add() returns
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS tests (id INTEGER PRIMARY KEY, num INTEGER NOT NULL, v0 REAL, res_st REAL, res_lt REAL, tested_at TEXT, retest INTEGER NOT NULL DEFAULT 0)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS tests_num ON tests (num)')
+            for key in KEYS:
+                self.db.execute(f'CREATE INDEX IF NOT EXISTS tests_{key} ON tests ({key})')
+            self.db.execute('CREATE TABLE IF NOT EXISTS stats (key TEXT PRIMARY KEY, count INTEGER, mean REAL, m2 REAL)')
+            for key in KEYS:
+                self.db.execute('INSERT OR IGNORE INTO stats VALUES (?, 0, 0.0, 0.0)', (key,))
+        self.stats = {key: list(self.db.execute('SELECT count, mean, m2 FROM stats WHERE key = ?', (key,)).fetchone()) for key in KEYS}
+        self.sorted = None      # every result of each key in order, only read in once something needs ranking
+
+    @property
+    def count(self):
+        return self.stats[KEYS[0]][0]
+
+    def add(self, cell:dict, tested_at:str = None):
+        # saves a result and returns the earlier tests of the same cell number, so a retest gets noticed straight away
+        if tested_at is None:
+            tested_at = datetime.now().isoformat(timespec='seconds')
+        with self.lock, self.db:
+            return self.insert(cell, tested_at)
+
+    def insert(self, cell:dict, tested_at:str):
+        previous = self.db.execute('SELECT v0, res_st, res_lt, tested_at FROM tests WHERE num = ? ORDER BY id', (int(cell['num']),)).fetchall()
+        self.db.execute('INSERT INTO tests (num, v0, res_st, res_lt, tested_at, retest) VALUES (?, ?, ?, ?, ?, ?)',
+                        (int(cell['num']), cell['v0'], cell['res_st'], cell['res_lt'], tested_at, int(len(previous) > 0)))
+        for key in KEYS:    # Welford's method, same as goodLab.Ranking
+            count, mean, m2 = self.stats[key]
+            count += 1
+            delta = cell[key] - mean
+            mean += delta / count
+            m2 += delta * (cell[key] - mean)
+            self.stats[key] = [count, mean, m2]
+            self.db.execute('UPDATE stats SET count = ?, mean = ?, m2 = ? WHERE key = ?', (count, mean, m2, key))
+        if self.sorted is not None:
+            for key in KEYS:
+                insort(self.sorted[key], cell[key])
+        return [{'v0': v0, 'res_st': res_st, 'res_lt': res_lt, 'tested_at': at} for v0, res_st, res_lt, at in previous]
+
+    def last_num(self):
+        with self.lock:
+            row = self.db.execute('SELECT num FROM tests ORDER BY id DESC LIMIT 1').fetchone()
+        return None if row is None else row[0]
+
+    def mean(self, key:str, default:float = None):
+        count, mean, _ = self.stats[key]
+        return mean if count > 0 else default
+
+    def std(self, key:str):
+        count, _, m2 = self.stats[key]
+        return (m2 / count) ** 0.5 if count > 0 else 0.0
+
+    def rank(self, key:str, value:float):
+        # 1 is the highest resistance, ties rank below the cells tested before them. the first call reads each index in
+        # order, which is the only O(n) step, after that it's O(log n) like goodLab.Ranking
+        with self.lock:
+            if self.sorted is None:
+                self.sorted = {k: [row[0] for row in self.db.execute(f'SELECT {k} FROM tests ORDER BY {k}')] for k in KEYS}
+            return self.count - bisect_left(self.sorted[key], value)
+
+    def percentile(self, key:str, value:float):
+        return (self.count - self.rank(key, value)) / max(1, (self.count - 1)) * 100
+
+    def import_csv(self, csv_path:str):
+        # loads a CSV written by goodLab.py into an empty database, only needed the first time
+        with open(csv_path, 'r') as csvfile, self.lock, self.db:     # one transaction for the whole file
+            reader = csv.DictReader(csvfile)
+            for row in reader:
+                self.insert({key: float(value) for key, value in row.items()}, '')
+
+    def export_csv(self, csv_path:str):
+        # writes the most recent result for each cell, so cellect.py doesn't stop on retested cells
+        with self.lock:
+            rows = self.db.execute('SELECT num, v0, res_st, res_lt FROM tests WHERE id IN (SELECT MAX(id) FROM tests GROUP BY num) ORDER BY num').fetchall()
+        with open(csv_path, 'w', newline = '') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(['num', 'v0', 'res_st', 'res_lt'])
+            for num, v0, res_st, res_lt in rows:
+                writer.writerow([f'{num:03d}', f'{v0}', f'{res_st}', f'{res_lt}'])
+        return len(rows)
+
+    def close(self):
+        self.db.close()
+
+if __name__ == '__main__':
+    # python results.py G7_2023.db G7_2023_latest.csv
+    if len(sys.argv) != 3 or not os.path.exists(sys.argv[1]):
+        print('usage: python results.py <database> <csv file to write>')
+        exit(1)
+    store = ResultStore(sys.argv[1])
+    print(f'Wrote {store.export_csv(sys.argv[2])} cells to {sys.argv[2]}')
@@ -0,0 +1,160 @@
+import argparse
+import os
+import sys
+import threading
+import queue
+from collections import Counter, deque
+from contextlib import contextmanager
+from time import perf_counter
+import numpy as np
+import pyvisa
+import goodLab
+from goodLab import Settings, debug, errors, log
+
+# tests cells without anyone at the keyboard. the cell numbers come from a file or, one per line, from stdin (a barcode
+# scanner types the number and presses enter). a cell that fails is retried and then skipped instead of stopping the
+# shift, and every so often it prints the cells/hour, how long each part of the test takes and what went wrong.
+#   python runner.py --cells lot7.txt
+#   python runner.py                            scan the cells as they go on the fixture, Ctrl+D or Ctrl+C to stop
+#   python runner.py --cells lot7.txt --retries 1 --low-voltage test
+
+PHASES = ['idle', 'v0', 'setup', 'trigger', 'analysis', 'save']     # idle is waiting for the next cell number
+
+class Throughput:
+    def __init__(self):
+        self.start = perf_counter()
+        self.done = deque()     # when each cell finished, for the rate over the last hour
+        self.count = 0
+        self.times = {phase: [] for phase in PHASES}
+        self.current = {}       # phase times of the attempt in progress
+        self.failures = Counter()
+        self.skipped = Counter()
+        self.retries = 0
+
+    @contextmanager
+    def phase(self, name:str):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = perf_counter() - start
+            self.times[name].append(elapsed)
+            self.current[name] = self.current.get(name, 0.0) + elapsed
+
+    def cell_done(self):
+        now = perf_counter()
+        self.count += 1
+        self.done.append(now)
+        while self.done[0] < now - 3600:
+            self.done.popleft()
+
+    def report(self):
+        hours = (perf_counter() - self.start) / 3600
+        lines = [f'{self.count} cells in {hours * 60:.1f} min, {self.count / hours if hours > 0 else 0:.0f} cells/hour overall, '
+                 f'{len(self.done) / min(1, hours) if hours > 0 else 0:.0f} in the last hour. '
+                 f'{sum(self.failures.values())} failed attempts, {self.retries} retries, {sum(self.skipped.values())} cells skipped']
+        for reason, count in (self.failures + self.skipped).most_common():
+            lines.append(f'    {count} x {reason}')
+        lines.append(f'    {"phase":<10}{"p50 (s)":>10}{"p90 (s)":>10}{"p99 (s)":>10}{"total (s)":>12}')
+        for name in PHASES:
+            if len(self.times[name]) > 0:
+                p50, p90, p99 = np.percentile(self.times[name], [50, 90, 99])
+                lines.append(f'    {name:<10}{p50:>10.2f}{p90:>10.2f}{p99:>10.2f}{sum(self.times[name]):>12.1f}')
+        print('\n'.join(lines) + '\n')
+
+def read_jobs(source, jobs:queue.Queue):
+    # runs on its own thread so a scanner can queue up the next cells while one is being tested
+    for line in source:
+        line = line.split('#')[0].strip()
+        if line != '':
+            jobs.put(line)
+    jobs.put(None)
+
+def test_one(session:goodLab.Session, load:goodLab.Load, scope:goodLab.Oscope, worker:goodLab.ResultWorker, cell_num:int, stats:Throughput, args):
+    # returns None if the cell was tested, otherwise why it wasn't
+    for attempt in range(args.retries + 1):
+        if attempt > 0:
+            stats.retries += 1
+            debug(f'Retrying cell {cell_num} ({attempt} of {args.retries})', True)
+        try:
+            with stats.phase('v0'):
+                v0 = load.v()
+            expected_min_v = v0 - max(Settings['i_sequence'][0]) * session.ranking.mean('res_lt', Settings['default_res'])
+            if expected_min_v < Settings['v_min'] and args.low_voltage == 'skip':
+                return f'voltage too low ({v0:.2f} V)'      # retrying won't charge it
+            if worker is not None:
+                with stats.phase('save'):
+                    worker.scope_free.wait()
+            result = goodLab.test_cell(load, scope, cell_num, v0, expected_min_v, stats.phase)
+            if result is None:
+                stats.failures['scope was not triggered'] += 1
+                continue
+            with stats.phase('save'):      # if this raises, the cell hasn't been ranked yet, so it's safe to test it again
+                goodLab.save_cell(session, scope, worker, {"num": cell_num, "v0": v0, "res_st": result[0], "res_lt": result[1]})
+            return None
+        except Exception as err:
+            log(f'cell {cell_num}: {err}: {type(err)}')
+            stats.failures[f'{type(err).__name__}: {err}'] += 1
+            try:
+                load.write('INP 0')     # make sure the load isn't left on before trying again
+            except Exception:
+                pass
+    return f'failed {args.retries + 1} times'
+
+def run(args):
+    rm = pyvisa.ResourceManager()
+    load_res, scope_res = goodLab.find_instruments(rm)
+    scope = goodLab.Oscope(scope_res)
+    load = goodLab.Load(load_res)
+    cell_data_path = f"{Settings['group_name']}.csv"
+    goodLab.setup_scope(scope, os.path.dirname(os.path.realpath(goodLab.__file__)))
+    session = goodLab.Session(cell_data_path, 1)
+    worker = goodLab.ResultWorker() if Settings['pipelined'] else None
+
+    jobs = queue.Queue()
+    source = open(args.cells, 'r') if args.cells is not None else sys.stdin
+    threading.Thread(target=read_jobs, args=(source, jobs), daemon=True).start()
+    stats = Throughput()
+    last_report = perf_counter()
+    try:
+        while True:
+            with stats.phase('idle'):
+                job = jobs.get()
+            if job is None:
+                break
+            try:
+                cell_num = int(job)
+            except ValueError:
+                errors([f'"{job}" is not a valid number, skipping it.'])
+                stats.skipped['not a cell number'] += 1
+                continue
+            stats.current = {}
+            reason = test_one(session, load, scope, worker, cell_num, stats, args)
+            if reason is None:
+                stats.cell_done()
+            else:
+                errors([f'Skipping cell {cell_num}: {reason}'])
+                stats.skipped[reason.split(' (')[0]] += 1
+            goodLab.logger.record({'cell': cell_num, 'status': 'tested' if reason is None else reason, 'phases': stats.current})
+            if (reason is None and stats.count % args.report_every == 0) or perf_counter() - last_report > args.report_s:
+                stats.report()
+                last_report = perf_counter()
+    except KeyboardInterrupt:
+        print('Stopping.')
+    finally:
+        load.write('INP 0')
+        if worker is not None:
+            worker.close()
+        if source is not sys.stdin:
+            source.close()
+        stats.report()
+        goodLab.commit_results(cell_data_path)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Test a queue of cells without prompts.')
+    parser.add_argument('--cells', help='file with one cell number per line, otherwise they are read from stdin')
+    parser.add_argument('--retries', type=int, default=2, help='how many more times to try a cell that fails before skipping it')
+    parser.add_argument('--low-voltage', choices=['skip', 'test'], default='skip', help='what to do with a cell that may drop below v_min')
+    parser.add_argument('--report-every', type=int, default=20, help='print the throughput after this many cells')
+    parser.add_argument('--report-s', type=float, default=600, help='or after this many seconds, whichever comes first')
+    run(parser.parse_args())
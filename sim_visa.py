@@ -0,0 +1,384 @@
+import time
+import numpy as np
+
+# a pretend pyvisa ResourceManager with a load, a scope and a cell hooked up to them, so goodLab.py can be run
+# (and timed) without the test bench. it only understands the commands goodLab.py actually sends.
+#
+# all the simulated instruments share a Clock. with virtual=True, sleeping and instrument latency just move
+# the clock forward instead of actually waiting, so a full cell test takes milliseconds but still reports
+# how long it would have taken on the bench.
+
+class Clock:
+    def __init__(self, virtual:bool = False):
+        self.virtual = virtual
+        self.offset = 0.0
+
+    def now(self):
+        return time.perf_counter() + self.offset
+
+    def sleep(self, secs:float):
+        if secs <= 0:
+            return
+        if self.virtual:
+            self.offset += secs
+        else:
+            time.sleep(secs)
+
+class SimTimeout(Exception):
+    pass
+
+class SimCell:
+    # a cell with an ohmic resistance and one RC pair for the slower polarization part
+    def __init__(self, v0:float = 3.49, r_st:float = 0.019, r_lt:float = 0.048, tau:float = 4.0):
+        self.v0 = v0
+        self.r_st = r_st
+        self.r_lt = r_lt
+        self.tau = tau
+
+    def v(self, t, i):
+        # terminal voltage for a current waveform i sampled at times t
+        t = np.atleast_1d(np.asarray(t, dtype=float))
+        i = np.atleast_1d(np.asarray(i, dtype=float))
+        # the polarization voltage changes slowly, so work it out on a coarse grid and interpolate
+        t_coarse = np.linspace(t[0], t[-1], min(len(t), 4000))
+        i_coarse = np.interp(t_coarse, t, i)
+        decay = np.exp(-np.diff(t_coarse, prepend=t_coarse[0]) / self.tau)
+        target = i_coarse * (self.r_lt - self.r_st)     # the RC pair relaxes towards this
+        vp = np.zeros_like(t_coarse)
+        for n in range(1, len(t_coarse)):
+            vp[n] = target[n] + (vp[n - 1] - target[n]) * decay[n]
+        return self.v0 - i * self.r_st - np.interp(t, t_coarse, vp)
+
+class SimBench:
+    # the physical state shared by the load and the scope
+    def __init__(self, clock:Clock, cell:SimCell = None, record_length:int = 1000000):
+        self.clock = clock
+        self.cell = cell if cell is not None else SimCell()
+        self.record_length = record_length
+        self.list_levels = {}
+        self.list_widths = {}
+        self.list_slew = {}
+        self.list_start = None      # clock time the load's list was triggered
+        self.input_on = False
+        self.input_on_during_list = False
+        self.triggered_at = None    # clock time of the last scope trigger
+
+    def list_steps(self):
+        steps = sorted(self.list_levels)
+        return [self.list_levels[n] for n in steps], [self.list_widths.get(n, 0) for n in steps], [self.list_slew.get(n, 0.1) for n in steps]
+
+    def current(self, t):
+        # load current at times t relative to the start of the list, as a piecewise linear waveform with the programmed slew
+        t = np.asarray(t, dtype=float)
+        levels, widths, slews = self.list_steps()
+        if len(levels) == 0 or not self.input_on_during_list:
+            return np.zeros_like(t)
+        times = [0.0]
+        values = [0.0]
+        start = 0.0
+        for level, width, slew in zip(levels, widths, slews):
+            slew_time = abs(level - values[-1]) / (slew * 1e6)
+            times += [start, start + slew_time]
+            values += [values[-1], level]
+            start += width
+        times += [start, start + abs(values[-1]) / (slews[-1] * 1e6)]
+        values += [values[-1], 0.0]
+        return np.interp(t, times, values, left=0.0, right=0.0)
+
+    def trigger_list(self):
+        self.list_start = self.clock.now()
+        self.input_on_during_list = self.input_on
+        if self.input_on and len(self.list_levels) > 0 and self.list_levels[min(self.list_levels)] > 0:
+            self.triggered_at = self.list_start
+
+    def list_duration(self):
+        return sum(self.list_steps()[1])
+
+    def list_running(self):
+        return self.list_start is not None and self.clock.now() < self.list_start + self.list_duration()
+
+    def now_current(self):
+        if self.list_start is None or not self.input_on:
+            return 0.0
+        return float(self.current(self.clock.now() - self.list_start))
+
+class SimResource:
+    # behaves like a pyvisa MessageBasedResource
+    def __init__(self, rm, resource_name:str):
+        self.rm = rm
+        self.resource_name = resource_name
+        self.timeout = 2000
+        self.reply = None
+
+    def transact(self, message:str, is_query:bool):
+        self.rm.round_trips += 1
+        self.rm.writes += 0 if is_query else 1
+        self.rm.queries += 1 if is_query else 0
+        self.rm.clock.sleep(self.rm.latency)
+        replies = []
+        path = ''
+        for cmd in message.split(';'):
+            cmd = cmd.strip()
+            if cmd == '':
+                continue
+            header, _, args = cmd.partition(' ')
+            if header.startswith(':') or header.startswith('*'):
+                header = header.lstrip(':')
+            elif path != '':
+                header = path + header      # a header without a leading colon is relative to the previous one
+            if ':' in header:
+                path = header[:header.rindex(':') + 1]
+            reply = self.handle(header.upper(), args.strip())
+            if reply is not None:
+                replies.append(str(reply))
+        return ';'.join(replies)
+
+    def write(self, message:str):
+        self.transact(message, False)
+
+    def query(self, message:str):
+        reply = self.transact(message, True)
+        if reply == '':
+            self.rm.clock.sleep(self.timeout / 1000)
+            raise SimTimeout(f'{self.resource_name} did not reply to {message}')
+        return reply + '\n'
+
+    def close(self):
+        pass
+
+class SimLoad(SimResource):
+    def __init__(self, rm, resource_name:str, bench:SimBench):
+        super().__init__(rm, resource_name)
+        self.bench = bench
+        self.errors = []
+        self.settings = {}
+
+    def handle(self, header:str, args:str):
+        bench = self.bench
+        if header == '*IDN?':
+            return 'B&K Precision, 8600 (simulated), 0, 1.0'
+        if header == '*RST':
+            self.settings = {}
+            bench.list_levels, bench.list_widths, bench.list_slew = {}, {}, {}
+            bench.input_on = False
+            return None
+        if header == '*OPC?':
+            return '1'
+        if header == '*TRG':
+            bench.trigger_list()
+            return None
+        if header == 'SYSTEM:ERROR?':
+            return self.errors.pop(0) if self.errors else '0,"No error"'
+        if header in ['SOURCE:CURRENT?', 'CURRENT?']:
+            return f'{self.settings.get("CURRENT", 0.0)}'
+        if header == 'FETCH:CURRENT?':
+            return f'{bench.now_current():.5f}'
+        if header == 'FETCH:VOLTAGE?':
+            now = bench.clock.now()
+            if bench.list_start is None:
+                return f'{bench.cell.v0:.5f}'
+            t = np.linspace(0, now - bench.list_start, 200)
+            i = bench.current(t) if bench.input_on else np.zeros_like(t)
+            return f'{float(bench.cell.v(t, i)[-1]):.5f}'
+        if header in ['INP', 'INPUT']:
+            bench.input_on = args in ['1', 'ON']
+            return None
+        if header in ['LIST:LEVEL', 'LIST:WIDTH', 'LIST:SLEW:BOTH']:
+            step, value = [x.strip() for x in args.split(',')]
+            {'LIST:LEVEL': bench.list_levels, 'LIST:WIDTH': bench.list_widths, 'LIST:SLEW:BOTH': bench.list_slew}[header][int(step)] = float(value)
+            return None
+        if header in ['FUNCTION:MODE', 'FUNCTION', 'CURRENT', 'LIST:SLOWRATE', 'LIST:RANGE', 'LIST:COUNT', 'LIST:STEP', 'TRIGGER:SOURCE']:
+            self.settings[header] = args
+            return None
+        if header in ['LIST:LEVEL?', 'LIST:WIDTH?', 'LIST:SLEW:BOTH?']:
+            return {'LIST:LEVEL?': bench.list_levels, 'LIST:WIDTH?': bench.list_widths, 'LIST:SLEW:BOTH?': bench.list_slew}[header].get(int(args), 0.0)
+        if header in ['FUNCTION:MODE?', 'FUNCTION?', 'LIST:SLOWRATE?', 'LIST:RANGE?', 'LIST:COUNT?', 'LIST:STEP?', 'TRIGGER:SOURCE?']:
+            return self.settings.get(header[:-1], '0')
+        self.errors.append(f'-113,"Undefined header {header}"')
+        return None
+
+class SimScope(SimResource):
+    def __init__(self, rm, resource_name:str, bench:SimBench, settings:dict):
+        super().__init__(rm, resource_name)
+        self.bench = bench
+        self.Settings = settings    # goodLab's Settings, so we know which channel is which
+        self.esr = 0
+        self.event_log = []
+        self.num_acq = 0
+        self.running = True
+        self.state = {
+            'HORIZONTAL:MODE:SCALE': 2.5,
+            'HORIZONTAL:POSITION': 50.0,
+            'HORIZONTAL:MODE': 'AUTO',
+        }
+        self.ready_at = 0.0     # clock time the scope will be able to trigger again after a settings change
+        self.search_results = []
+        self.search_index = 0
+        self.record = None      # (t, {channel: y}) of the last acquisition
+
+    def handle(self, header:str, args:str):
+        bench = self.bench
+        self.update_acquisition()
+        if header == '*IDN?':
+            return 'TEKTRONIX,MSO54 (simulated),0,1.0'
+        if header == '*OPC':
+            self.esr |= 0b1
+            return None
+        if header == '*ESR?':
+            esr, self.esr = self.esr, 0
+            return esr
+        if header == 'ALLEV?':
+            events, self.event_log = self.event_log, []
+            return ','.join(events) if events else '0,"No events to report"'
+        if header == 'SET?':
+            return ';'.join(f':{key} {value}' for key, value in self.state.items())
+        if header == 'ACQUIRE:NUMACQ?':
+            return self.num_acq
+        if header == 'ACQUIRE:STATE':
+            self.running = args.upper() in ['RUN', '1', 'ON']
+            return None
+        if header == 'ACQUIRE:STATE?':
+            return 1 if self.running else 0
+        if header == 'TRIGGER:STATE?':
+            return 'READY' if bench.clock.now() >= self.ready_at else 'ARMED'
+        if header == 'HORIZONTAL:RECORDLENGTH?':
+            return bench.record_length
+        if header.endswith('?') and header[:-1] in self.state:
+            return self.state[header[:-1]]
+        if header == 'DISPLAY:WAVEVIEW1:ZOOM:ZOOM1:HORIZONTAL:POSITION?':
+            t = self.search_results[self.search_index] if self.search_results else 0.0
+            return f'{self.state["HORIZONTAL:POSITION"] + 10 * t / self.state["HORIZONTAL:MODE:SCALE"]:.6E}'
+        if header == 'SEARCH:SEARCH1:TOTAL?':
+            self.run_search()
+            return len(self.search_results)
+        if header in ['SEARCH:SEARCH1:NAV', 'SEARCH:SEARCH1:NAVIGATE']:
+            self.run_search()
+            step = 1 if args.upper() == 'NEXT' else -1
+            self.search_index = min(max(self.search_index + step, 0), max(len(self.search_results) - 1, 0))
+            return None
+        if header == 'DISPLAY:WAVEVIEW1:CURSOR:CURSOR1:HBARS:DELTA?':
+            t, y = self.waveform(self.Settings['v_channel'])
+            a = self.state.get('DISPLAY:WAVEVIEW1:CURSOR:CURSOR1:VBARS:APOSITION', 0.0)
+            b = self.state.get('DISPLAY:WAVEVIEW1:CURSOR:CURSOR1:VBARS:BPOSITION', 0.0)
+            return f'{abs(np.interp(b, t, y) - np.interp(a, t, y)):.6E}'      # the cursor readout is always positive
+        if header.startswith('MEASUREMENT:MEAS') and header.endswith('MINIMUM?'):
+            t, y = self.waveform(self.Settings['v_channel'])
+            return f'{float(np.min(y)):.6E}'
+        if header.startswith('WFMOUTPRE:') and header.endswith('?'):
+            return self.preamble(self.state.get('DATA:SOURCE', 'CH1'))[header[len('WFMOUTPRE:'):-1]]
+        if header in ['RECALL:SETUP', 'FILES:CWD', 'FILES:MKDIR', 'SAVE:WAVEFORM']:
+            if header == 'RECALL:SETUP':
+                self.state = {key: value for key, value in self.state.items() if key.startswith('HORIZONTAL')}
+            if header == 'SAVE:WAVEFORM':
+                self.rm.saved.append(args)
+            return None
+        if header.endswith('?'):
+            self.esr |= 0b100000    # command error
+            self.event_log.append(f'-113,"Undefined header; {header}"')
+            return None
+        try:
+            self.state[header] = float(args)
+        except ValueError:
+            self.state[header] = args.strip('"')
+        if header.startswith('CH') or header.startswith('HORIZONTAL'):
+            # changing the scale restarts the acquisition, it has to capture the pre-trigger part before it can trigger again
+            pre_trigger = self.state['HORIZONTAL:MODE:SCALE'] * 10 * self.state['HORIZONTAL:POSITION'] / 100
+            self.ready_at = bench.clock.now() + pre_trigger
+        return None
+
+    def update_acquisition(self):
+        # the scope finishes an acquisition once the post trigger part of the record has been captured
+        bench = self.bench
+        if bench.triggered_at is None or not self.running:
+            return
+        if bench.triggered_at < self.ready_at:      # it wasn't ready, so the trigger was missed
+            bench.triggered_at = None
+            return
+        record_duration = self.state['HORIZONTAL:MODE:SCALE'] * 10
+        post_trigger = record_duration * (1 - self.state['HORIZONTAL:POSITION'] / 100)
+        if bench.clock.now() >= bench.triggered_at + post_trigger:
+            pre_trigger = record_duration - post_trigger
+            t = np.linspace(-pre_trigger, post_trigger, bench.record_length)
+            i = bench.current(t)
+            v = bench.cell.v(t, i)
+            self.record = (t, {self.Settings['v_channel']: v, self.Settings['i_channel']: i / self.Settings['i_scale_factor']})
+            self.num_acq += 1
+            bench.triggered_at = None
+
+    def waveform(self, channel:int):
+        if self.record is None:
+            t = np.linspace(-1, 1, self.bench.record_length)
+            return t, np.zeros_like(t)
+        return self.record[0], self.record[1][channel]
+
+    def run_search(self):
+        source = str(self.state.get('SEARCH:SEARCH1:TRIGGER:A:EDGE:SOURCE', 'CH1'))
+        threshold = float(self.state.get('SEARCH:SEARCH1:TRIGGER:A:EDGE:THRESHOLD', 0.0))
+        rising = str(self.state.get('SEARCH:SEARCH1:TRIGGER:A:EDGE:SLOPE', 'RISE')).upper().startswith('RIS')
+        key = (source, threshold, rising, self.num_acq)
+        if getattr(self, 'search_key', None) == key:
+            return
+        self.search_key = key
+        t, y = self.waveform(int(source.upper().lstrip('CH')))
+        if rising:
+            hits = np.flatnonzero((y[:-1] <= threshold) & (y[1:] > threshold))
+        else:
+            hits = np.flatnonzero((y[:-1] >= threshold) & (y[1:] < threshold))
+        self.search_results = list(t[hits + 1])
+        self.search_index = -1
+
+    def preamble(self, source:str):
+        channel = int(str(source).upper().lstrip('CH'))
+        t, y = self.waveform(channel)
+        scale = float(self.state.get(f'CH{channel}:SCALE', 1.0))
+        position = float(self.state.get(f'CH{channel}:POSITION', 0.0))
+        offset = float(self.state.get(f'CH{channel}:OFFSET', 0.0))
+        return {
+            'XINCR': f'{t[1] - t[0]:.6E}',
+            'XZERO': f'{t[0]:.6E}',
+            'PT_OFF': '0',
+            'YMULT': f'{scale * 10 / 60000:.6E}',     # 16 bit samples cover a bit more than the 10 divisions on screen
+            'YOFF': '0',
+            'YZERO': f'{offset - position * scale:.6E}',
+        }
+
+    def query_binary_values(self, message:str, datatype:str = 'h', is_big_endian:bool = False, container = list):
+        self.rm.round_trips += 1
+        self.rm.queries += 1
+        self.rm.clock.sleep(self.rm.latency)
+        self.update_acquisition()
+        source = self.state.get('DATA:SOURCE', 'CH1')
+        t, y = self.waveform(int(str(source).upper().lstrip('CH')))
+        preamble = {key: float(value) for key, value in self.preamble(source).items()}
+        raw = np.clip(np.round((y - preamble['YZERO']) / preamble['YMULT'] + preamble['YOFF']), -32768, 32767).astype(np.int16)
+        self.rm.clock.sleep(raw.nbytes / self.rm.bandwidth)
+        return container(raw)
+
+class SimResourceManager:
+    # drop-in for pyvisa.ResourceManager(). latency is the time each write or query takes in seconds,
+    # bandwidth is in bytes per second for binary waveform transfers. stations is how many load/scope pairs there are
+    def __init__(self, settings:dict, latency:float = 0.002, bandwidth:float = 20e6, clock:Clock = None, cell:SimCell = None, record_length:int = 1000000, stations:int = 1):
+        self.clock = clock if clock is not None else Clock()
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.benches = [SimBench(self.clock, cell, record_length) for _ in range(stations)]
+        self.bench = self.benches[0]
+        self.settings = settings
+        self.round_trips = self.writes = self.queries = 0
+        self.saved = []
+        self.resources = {'ASRL1::INSTR': None}    # a serial port that isn't an instrument
+        for n, bench in enumerate(self.benches):
+            self.resources[f'USB0::0x2EC7::0x8600::SIM{2 * n + 1:04d}::INSTR'] = lambda name, bench=bench: SimLoad(self, name, bench)
+            self.resources[f'USB0::0x0699::0x0522::SIM{2 * n + 2:04d}::INSTR'] = lambda name, bench=bench: SimScope(self, name, bench, self.settings)
+
+    def list_resources(self):
+        return tuple(sorted(self.resources))     # VISA lists them in order, which puts the scope before the load
+
+    def open_resource(self, resource_name:str, **kwargs):
+        self.clock.sleep(self.latency)
+        if self.resources.get(resource_name) is None:
+            raise SimTimeout(f'{resource_name} is not a VISA instrument')
+        resource = self.resources[resource_name](resource_name)
+        for key, value in kwargs.items():
+            setattr(resource, key, value)
+        return resource